@@ -0,0 +1,277 @@
+# エンドツーエンドの負荷ベンチマーク
+# Chat Session の1ターン（プロンプト組み立て → 危機判定 → ストリーミング生成 → ログ）と
+# run_simulation_for_user_slow（擬似ユーザー）を、/generate のモックに向けて流し、
+#   turns/sec, ターン所要時間の p50/p95/p99, API の再試行回数, 1ターンあたりの Sheets 呼び出し数
+# を出す。
+# 使い方:
+#   python bench_load.py --mock --mode both --users 8 --turns 20 --latency-ms 500 --error-rate 0.05
+#   python bench_load.py --url http://127.0.0.1:8765/generate --mode sim --batch-size 8
+# Sheets は既定でメモリ上のバックエンド（memory_sheets.py）を使う。--sheets gspread なら
+# st.secrets の認証情報で開いた本物のスプレッドシート（ベンチ用のユーザー名は "Bench ..." で始まる）。
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import mock_generate_server
+
+BENCH_MESSAGES = [
+    "I have been feeling stressed about my exams and I can't sleep well.",
+    "My roommate and I keep arguing about small things.",
+    "Work has been overwhelming and I feel like I'm falling behind.",
+    "I moved to a new city and I don't know anyone yet.",
+    "I keep procrastinating on my dissertation and feel guilty about it.",
+    "Lately I feel tired all the time even when I rest.",
+    "I had a good day today but I'm worried it won't last.",
+    "My family expects a lot from me and it's hard to say no.",
+]
+
+
+class CallCounter:
+    """Sheets API 呼び出し（メソッド名ごと）の数え上げ。ログ書き込みスレッドからも呼ばれる"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def hit(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.calls)
+
+
+class _Counting:
+    """gspread のオブジェクトを包み、メソッド呼び出しを CallCounter に記録する"""
+    def __init__(self, target, counter, prefix):
+        self._target = target
+        self._counter = counter
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr   # title / id などのプロパティは API 呼び出しではない
+
+        def call(*args, **kwargs):
+            self._counter.hit(f"{self._prefix}.{name}")
+            result = attr(*args, **kwargs)
+            if hasattr(result, "append_rows"):   # worksheet() / add_worksheet() の戻り値
+                return _Counting(result, self._counter, "Worksheet")
+            return result
+        return call
+
+
+def install_sheets_counter(core, counter):
+    """chat_core.get_worksheet が開くシートをすべて数え上げ付きにする（最初の get_worksheet より前に呼ぶ）"""
+    spreadsheet = _Counting(core.get_spreadsheet(), counter, "Spreadsheet")
+    core.get_spreadsheet = lambda: spreadsheet
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+def bench_profile(rng):
+    return {t: rng.choice([20, 35, 50, 65, 80]) for t in
+            ["Extraversion", "Agreeableness", "Conscientiousness", "Emotional Stability", "Openness"]}
+
+
+def run_chat_user(core, username, profile, turns, flip_after, condition, latencies, ttfts):
+    """Chat Session 画面の1ユーザー分（画面の処理と同じ順序で1ターンずつ）"""
+    core.ensure_personality_row(username, str(uuid.uuid4()), condition, profile,
+                                responses_json=json.dumps({"source": "bench"}))
+    session_id = str(uuid.uuid4())
+    chat_history = []
+    client = core.get_generation_client()
+    rng = random.Random(username)
+    for turn_index in range(1, turns + 1):
+        user_input = rng.choice(BENCH_MESSAGES)
+        start = time.monotonic()
+        profile_row = core.get_profile(username) or profile   # 画面は再実行のたびにプロフィールを引く
+        matched = (condition != "Fixed Empathy") and turn_index >= flip_after
+        prompt, used = core.build_chat_prompt(profile_row, condition, turn_index, chat_history, user_input)
+        ai_reply = core.handle_crisis(user_input)
+        if not ai_reply:
+            parts = []
+            for token in client.stream(prompt, conversation_id=session_id):
+                if not parts:
+                    ttfts.append(time.monotonic() - start)
+                parts.append(token)
+            ai_reply = core.clean_reply("".join(parts)) if parts else "The system could not generate a response."
+        chat_history.append({"role": "User", "content": user_input})
+        chat_history.append({"role": "AI", "content": ai_reply})
+        phase = (("Matched" if matched else "NoMatch") if condition != "Fixed Empathy" else "")
+        ws = core.get_user_log_ws_cached(username, matched, experiment_condition=condition)
+        core.log_chat_to_sheet(
+            ws, session_id, username, user_input, ai_reply, datetime.utcnow().isoformat(),
+            condition, matched, turn_index, phase, 0, 0,
+            used.get("E", ""), used.get("A", ""), used.get("C", ""), used.get("ES", ""), used.get("O", ""),
+        )
+        latencies.append(time.monotonic() - start)
+
+
+def run_sim_users(core, args, usernames, latencies):
+    """run_simulations_concurrently と同じ構成（共通 RateLimiter・任意でバッチ）で擬似ユーザーを流す"""
+    limiter = core.RateLimiter(args.rps)
+    batcher = None
+    if args.batch_size > 1:
+        batcher = core.GenerationBatcher(core.get_generation_client(), max_batch_size=args.batch_size,
+                                         max_wait_sec=args.batch_wait_ms / 1000.0, limiter=limiter)
+    lock = threading.Lock()
+
+    def _run(i, username):
+        rng = random.Random(username)
+        inputs = [rng.choice(BENCH_MESSAGES) for _ in range(args.turns)]
+        last = [time.monotonic()]
+
+        def on_turn(t, n):
+            now = time.monotonic()
+            with lock:
+                latencies.append(now - last[0])
+            last[0] = now
+
+        core.run_simulation_for_user_slow(
+            username, bench_profile(rng), inputs, str(uuid.uuid4()), flip_after=args.flip_after,
+            experiment_condition="Personalized Empathy" if i % 2 else "Fixed Empathy",
+            limiter=limiter, on_turn=on_turn, batcher=batcher,
+        )
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="bench-sim") as pool:
+            for f in [pool.submit(_run, i, u) for i, u in enumerate(usernames)]:
+                f.result()
+    finally:
+        if batcher is not None:
+            batcher.close()
+
+
+def run_mode(core, args, mode, counter):
+    client = core.get_generation_client()
+    api_before, sheets_before = client.stats(), counter.snapshot()
+    latencies, ttfts = [], []
+    tag = uuid.uuid4().hex[:6]
+    start = time.monotonic()
+    if mode == "chat":
+        rng = random.Random(args.seed)
+        with ThreadPoolExecutor(max_workers=args.users, thread_name_prefix="bench-chat") as pool:
+            futures = [
+                pool.submit(run_chat_user, core, f"Bench Chat {tag} {i}", bench_profile(rng), args.turns,
+                            args.flip_after, "Personalized Empathy" if i % 2 else "Fixed Empathy",
+                            latencies, ttfts)
+                for i in range(args.users)
+            ]
+            for f in futures:
+                f.result()
+    else:
+        run_sim_users(core, args, [f"Bench Sim {tag} {i}" for i in range(args.users)], latencies)
+    core.get_log_pipeline().flush()
+    elapsed = time.monotonic() - start
+
+    api_after, sheets_after = client.stats(), counter.snapshot()
+    sheets = sheets_after - sheets_before
+    turns = len(latencies)
+    return {
+        "mode": mode,
+        "users": args.users,
+        "turns": turns,
+        "elapsed_sec": round(elapsed, 3),
+        "turns_per_sec": round(turns / elapsed, 3) if elapsed > 0 else None,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "ttft_p50_ms": round(percentile(ttfts, 50) * 1000, 1) if ttfts else None,
+        "api_requests": api_after["requests"] - api_before["requests"],
+        "api_retries": api_after["retries"] - api_before["retries"],
+        "api_failures": api_after["failures"] - api_before["failures"],
+        "sheets_calls": sum(sheets.values()),
+        "sheets_calls_per_turn": round(sum(sheets.values()) / turns, 3) if turns else None,
+        "sheets_calls_by_method": dict(sheets),
+        "log_pipeline": core.get_log_pipeline().stats(),
+        "sheets_quota": core.sheets_quota_stats(),
+    }
+
+
+def print_report(r):
+    print(f"\n== {r['mode']} ({r['users']} users, {r['turns']} turns, {r['elapsed_sec']}s) ==")
+    print(f"throughput      {r['turns_per_sec']} turns/sec")
+    print(f"turn latency    p50 {r['latency_p50_ms']} ms / p95 {r['latency_p95_ms']} ms / p99 {r['latency_p99_ms']} ms")
+    if r["ttft_p50_ms"] is not None:
+        print(f"first token     p50 {r['ttft_p50_ms']} ms")
+    print(f"API             {r['api_requests']} requests, {r['api_retries']} retries, {r['api_failures']} failed")
+    print(f"Sheets          {r['sheets_calls']} calls ({r['sheets_calls_per_turn']} per turn)")
+    for name, n in sorted(r["sheets_calls_by_method"].items()):
+        print(f"  {name:32s} {n}")
+    quota = r["sheets_quota"]
+    if quota is not None:
+        print(f"Sheets quota    peak {quota['peak_reads_per_min']}/{quota['read_limit']} reads/min, "
+              f"{quota['peak_writes_per_min']}/{quota['write_limit']} writes/min, "
+              f"{quota['throttled']} throttled, {quota['injected']} injected errors")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark against a /generate stand-in")
+    parser.add_argument("--mode", choices=["chat", "sim", "both"], default="both")
+    parser.add_argument("--url", default=None, help="/generate の URL（--mock なら不要）")
+    parser.add_argument("--mock", action="store_true", help="モックサーバーをこのプロセス内で起動する")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--flip-after", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=4, help="sim: 同時に走らせる擬似ユーザー数")
+    parser.add_argument("--rps", type=float, default=0, help="sim: API 呼び出しの上限 (0 = 制限なし)")
+    parser.add_argument("--batch-size", type=int, default=0, help="sim: /generate_batch にまとめる件数")
+    parser.add_argument("--batch-wait-ms", type=float, default=50.0)
+    parser.add_argument("--sheets", choices=["memory", "gspread"], default="memory", help="Sheets のバックエンド")
+    parser.add_argument("--sheets-latency-ms", type=float, default=0.0, help="memory: 1呼び出しごとの待ち (ms)")
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0, help="memory: 429 を返す割合")
+    parser.add_argument("--sheets-enforce-quota", action="store_true", help="memory: 分あたり上限を超えたら 429")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    mock_generate_server.add_config_args(parser)
+    args = parser.parse_args()
+
+    mock_config = None
+    if args.mock:
+        mock_config = mock_generate_server.config_from_args(args)
+        _, args.url = mock_generate_server.start_in_thread(config=mock_config)
+    if not args.url:
+        parser.error("--url か --mock を指定してください")
+    # chat_core は import 時に API_URL / Sheets のバックエンドを決めるので、先に環境変数で渡す
+    os.environ["GEN_API_URL"] = args.url
+    os.environ["SHEETS_BACKEND"] = args.sheets
+    os.environ["SHEETS_MEMORY_LATENCY_MS"] = str(args.sheets_latency_ms)
+    os.environ["SHEETS_MEMORY_ERROR_RATE"] = str(args.sheets_error_rate)
+    os.environ["SHEETS_MEMORY_ENFORCE_QUOTA"] = "1" if args.sheets_enforce_quota else "0"
+    import chat_core as core
+
+    counter = CallCounter()
+    install_sheets_counter(core, counter)
+    modes = ["chat", "sim"] if args.mode == "both" else [args.mode]
+    results = [run_mode(core, args, mode, counter) for mode in modes]
+    core.get_log_pipeline().shutdown()
+
+    if args.json:
+        json.dump(results, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        for r in results:
+            print_report(r)
+        if mock_config is not None:
+            ms = mock_config.stats
+            share = ms["reused_prefix_chars"] / ms["prompt_chars"] if ms["prompt_chars"] else 0.0
+            print(f"\nmock server     {ms['generate']} /generate, {ms['generate_batch']} /generate_batch, "
+                  f"{ms['errors']} errors, {ms['cold_starts']} cold starts, "
+                  f"prefix shared with previous turn {share:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2072 @@
+# Streamlit 画面から切り出した共通処理（Sheets / ログ / データセット / 生成 API / シミュレーション）
+# 画面（統合版のwebページ test.py）とベンチマーク（bench_load.py）の両方から import する
+import streamlit as st
+import gspread
+import json
+from datetime import datetime
+from oauth2client.service_account import ServiceAccountCredentials
+import requests
+import requests.adapters
+import uuid
+import time
+import random
+import email.utils
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
+import re
+import hashlib
+import unicodedata
+import sqlite3
+import atexit
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from typing import Optional
+from collections.abc import Sequence
+
+import memory_sheets
+import prompts
+
+# === Google Sheets 認証 ===
+SPREADSHEET_KEY = "1XpB4gzlkOS72uJMADmSIuvqECM5Ud8M-KwwJbXSxJxM"
+SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+# Sheets のバックエンド: "gspread"（本番）/ "memory"（memory_sheets.py、オフライン実行・負荷試験用）
+SHEETS_BACKEND = os.environ.get("SHEETS_BACKEND", "gspread")
+SHEETS_MEMORY_PATH = os.environ.get("SHEETS_MEMORY_PATH") or None             # 指定すると JSON に保存・復元
+SHEETS_MEMORY_ENFORCE_QUOTA = os.environ.get("SHEETS_MEMORY_ENFORCE_QUOTA") == "1"  # 分あたり上限超過で 429
+SHEETS_MEMORY_ERROR_RATE = float(os.environ.get("SHEETS_MEMORY_ERROR_RATE", "0"))  # ランダムに 429 を返す割合
+SHEETS_MEMORY_LATENCY_MS = float(os.environ.get("SHEETS_MEMORY_LATENCY_MS", "0"))
+
+PERSONALITY_HEADER = [
+    "Username","SessionID","ExperimentCondition",
+    "Extraversion","Agreeableness","Conscientiousness","Emotional Stability","Openness",
+    "Responses"
+]
+
+@st.cache_resource(show_spinner=False)
+def get_gspread_client():
+    """
+    プロセス共通の gspread クライアント（rerun のたびに認証し直さない）。
+    一時ファイルは作らずメモリ上の dict から認証する。
+    アクセストークンの期限切れは gspread の認証済みセッションが自動で更新する。
+    """
+    creds_dict = st.secrets["GOOGLE_SERVICE_ACCOUNT_JSON"].to_dict()
+    creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
+    credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+    return gspread.authorize(credentials)
+
+@st.cache_resource(show_spinner=False)
+def get_spreadsheet():
+    if SHEETS_BACKEND == "memory":
+        return memory_sheets.open_memory_spreadsheet(
+            SHEETS_MEMORY_PATH,
+            seed_sheets={"Personality": PERSONALITY_HEADER},
+            quota=memory_sheets.QuotaMeter(enforce=SHEETS_MEMORY_ENFORCE_QUOTA, error_rate=SHEETS_MEMORY_ERROR_RATE),
+            latency_sec=SHEETS_MEMORY_LATENCY_MS / 1000.0,
+        )
+    return get_gspread_client().open_by_key(SPREADSHEET_KEY)
+
+def sheets_quota_stats():
+    """memory バックエンドのときだけ、分あたりの read/write 数と上限を返す（gspread では None）"""
+    quota = getattr(get_spreadsheet(), "quota", None)
+    return quota.stats() if quota is not None else None
+
+@st.cache_resource(show_spinner=False)
+def _worksheet_handles():
+    """title -> Worksheet（プロセス共通。全セッションで使い回す）"""
+    return {"lock": threading.Lock(), "ws": {}}
+
+def get_worksheet(title, header=None, rows="5000"):
+    """
+    ワークシートのハンドルを返す（初回だけ API で取得）。
+    header を渡した場合、シートが無ければ作成してヘッダ行を書く。
+    """
+    handles = _worksheet_handles()
+    with handles["lock"]:
+        if title in handles["ws"]:
+            return handles["ws"][title]
+        spreadsheet = get_spreadsheet()
+        try:
+            ws = spreadsheet.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            if header is None:
+                raise
+            try:
+                ws = spreadsheet.add_worksheet(
+                    title=title,
+                    rows=rows,                         # 小さく開始（append_rowで自動拡張）
+                    cols=str(len(header))              # ヘッダ分だけ確保
+                )
+                ws.append_row(header)
+            except gspread.exceptions.APIError as e:
+                # 競合で既に作られた可能性 → 取り直し
+                try:
+                    ws = spreadsheet.worksheet(title)
+                except Exception:
+                    raise e
+        handles["ws"][title] = ws
+        return ws
+
+
+
+# --- Worksheet & Profiles キャッシュ ---
+LOG_HEADER = [
+    "SessionID","Username","Role","Message","Timestamp",
+    "ExperimentCondition","MatchedMode","Turn","Phase",
+    "GroupID","UserIndex","GroupUser",
+    # One-hot（必要なら残す／セル節約したいなら削除OK）
+    "Group 1","Group 2","Group 3","Group 4","Group 5",
+    "Group 6","Group 7","Group 8","Group 9","Group 10",
+    "Tone_E","Tone_A","Tone_C","Tone_ES","Tone_O"
+]
+
+def get_user_log_ws_cached(username: str, matched: bool, experiment_condition=None):
+    """
+    Fixed → LOGS_FIXED
+    Personalized → LOGS_PERS_NOMATCH / LOGS_PERS_MATCHED
+    experiment_condition 省略時はセッションの条件（シミュレーションのワーカースレッドからは明示的に渡す）
+    """
+    exp_cond = experiment_condition or st.session_state.get("experiment_condition", "Unknown")
+    if exp_cond == "Fixed Empathy":
+        sheet_name = "LOGS_FIXED"
+    else:
+        sheet_name = "LOGS_PERS_MATCHED" if matched else "LOGS_PERS_NOMATCH"
+    return get_worksheet(sheet_name, header=LOG_HEADER)
+
+
+
+
+def safe_append_ws(ws, row, retries=5, base_delay=2.0):
+    return safe_append_rows_ws(ws, [row], retries=retries, base_delay=base_delay)
+
+def safe_append_rows_ws(ws, rows, retries=5, base_delay=2.0, report=True):
+    """
+    rows をまとめて append_rows 1回で書き込む。
+    APIError 時のリトライ（2s, 4s, 6s, ...）は safe_append_ws と同じくバッチ全体に適用。
+    report=False はバックグラウンドスレッド用（st.error を出さない）
+    """
+    for i in range(retries):
+        try:
+            ws.append_rows(rows)
+            return True
+        except gspread.exceptions.APIError:
+            time.sleep(base_delay * (i + 1))
+    if report:
+        st.error(f"Failed to append {len(rows)} row(s) after multiple retries.")
+    return False
+
+
+# --- LOGS_* の書き込み: ローカルの追記ログ（WAL）→ バックグラウンドで Sheets に複製 ---
+# ターンの行はまず SQLite に書き（ディスクの速さで返る）、専用スレッドが append_rows でまとめて LOGS_* に送る。
+# Sheets が落ちていても行は失われず、再起動後は複製済みの位置（シートごとの watermark）から続きを送る。
+# memory バックエンドの行が本番のシートに複製されないよう、ファイルを分ける
+TURN_LOG_PATH = os.environ.get("TURN_LOG_PATH") or (
+    ".cache/turn_log.sqlite" if SHEETS_BACKEND == "gspread" else f".cache/turn_log_{SHEETS_BACKEND}.sqlite"
+)
+LOG_FLUSH_MAX_ROWS = 40           # これだけ溜まったら送る
+LOG_FLUSH_MAX_AGE_SEC = 10.0      # 一番古い未送信行からこの秒数が経ったら送る
+LOG_REPLICATE_BATCH_ROWS = 500    # append_rows 1回の上限
+LOG_REPLICATE_POLL_SEC = 0.5
+LOG_RETRY_BASE_SEC = 2.0          # 送信失敗時の待ち（シートごとに 2, 4, 8, ... 秒、上限 LOG_RETRY_MAX_SEC）
+LOG_RETRY_MAX_SEC = 300.0
+LOG_FLUSH_TIMEOUT_SEC = 120.0     # flush(wait=True) の待ち上限（超えても行はローカルに残っている）
+LOG_LEASE_SEC = 60.0              # 複製を担当するプロセスのリース（複数プロセスで同じ行を二重に送らない）
+LOG_RETAIN_SEC = 7 * 24 * 3600    # 複製済みの行をローカルに残す期間
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class TurnLog:
+    """
+    LOGS_* 行の追記専用ストア（SQLite, WAL モード）。
+    rows: seq 順に追記。replicated: シートごとに「ここまで送った seq」。lease: 複製担当のプロセス。
+    synchronous=NORMAL なのでプロセスが落ちても書いた行は残る（OS ごと落ちた場合は直近の数件を失いうる）。
+    """
+    def __init__(self, path=TURN_LOG_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rows ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT, sheet TEXT NOT NULL, username TEXT, session_id TEXT,"
+            " turn INTEGER, row TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS rows_sheet_seq ON rows(sheet, seq)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS rows_username ON rows(username, seq)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS replicated (sheet TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS lease (id INTEGER PRIMARY KEY CHECK (id = 1), owner TEXT, expires REAL)")
+
+    def append(self, sheet, rows):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO rows (sheet, username, session_id, turn, row, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(sheet, r[1], r[0], _int_or_none(r[7]), json.dumps(r, ensure_ascii=False), now) for r in rows],
+                )
+                seq = self._conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return seq
+
+    def user_rows(self, username, session_id, after_turn=0):
+        """username の session_id の行（turn > after_turn）を書いた順に返す。再開時に Sheets へ未反映のターンを拾う用"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row FROM rows WHERE username = ? AND session_id = ? AND turn > ? ORDER BY seq",
+                (username, session_id, after_turn),
+            ).fetchall()
+        return [json.loads(r) for r, in rows]
+
+    def user_sessions(self, username):
+        """username の行がある SessionID（同じ名前の別セッションを見つける用）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT session_id FROM rows WHERE username = ?", (username,)
+            ).fetchall()
+        return {sid for sid, in rows if sid}
+
+    def session_rows(self, username, session_id):
+        """username の session_id の行を [(シート名, 行)] で書いた順に返す（シミュレーション結果の書き出し用）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT sheet, row FROM rows WHERE username = ? AND session_id = ? ORDER BY seq", (username, session_id)
+            ).fetchall()
+        return [(sheet, json.loads(r)) for sheet, r in rows]
+
+    def replicated_seqs(self):
+        """シートごとの「ここまで送った seq」（どのプロセスが送ったかは問わない）"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT sheet, seq FROM replicated").fetchall())
+
+    def max_seq(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM rows").fetchone()[0]
+
+    def pending(self):
+        """シートごとの未送信行 {sheet: (件数, 最小 seq, 一番古い行の時刻)}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT r.sheet, COUNT(*), MIN(r.seq), MIN(r.created) FROM rows r"
+                " LEFT JOIN replicated w ON w.sheet = r.sheet"
+                " WHERE r.seq > COALESCE(w.seq, 0) GROUP BY r.sheet"
+            ).fetchall()
+        return {sheet: (n, first, oldest) for sheet, n, first, oldest in rows}
+
+    def read_pending(self, sheet, limit=LOG_REPLICATE_BATCH_ROWS):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, row FROM rows WHERE sheet = ?"
+                " AND seq > COALESCE((SELECT seq FROM replicated WHERE sheet = ?), 0) ORDER BY seq LIMIT ?",
+                (sheet, sheet, limit),
+            ).fetchall()
+        return [seq for seq, _ in rows], [json.loads(r) for _, r in rows]
+
+    def mark_replicated(self, sheet, seq):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO replicated (sheet, seq) VALUES (?, ?)"
+                " ON CONFLICT(sheet) DO UPDATE SET seq = MAX(seq, excluded.seq)",
+                (sheet, seq),
+            )
+
+    def acquire_lease(self, owner, ttl=LOG_LEASE_SEC):
+        """複製担当のリースを取る（または延長する）。取れたら True"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO lease (id, owner, expires) VALUES (1, NULL, 0)")
+            cur = self._conn.execute(
+                "UPDATE lease SET owner = ?, expires = ? WHERE id = 1 AND (owner = ? OR owner IS NULL OR expires < ?)",
+                (owner, now + ttl, owner, now),
+            )
+            return cur.rowcount == 1
+
+    def release_lease(self, owner):
+        with self._lock:
+            self._conn.execute("UPDATE lease SET owner = NULL, expires = 0 WHERE id = 1 AND owner = ?", (owner,))
+
+    def prune(self, retain_sec=LOG_RETAIN_SEC):
+        """複製済みで古い行を消す"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM rows WHERE created < ?"
+                " AND seq <= COALESCE((SELECT seq FROM replicated WHERE replicated.sheet = rows.sheet), 0)",
+                (time.time() - retain_sec,),
+            )
+
+
+class LogReplicator:
+    """
+    log_chat_to_sheet から渡された行を TurnLog に書いて即座に返し、専用スレッドが LOGS_* に複製する。
+    - シートごとに LOG_FLUSH_MAX_ROWS 行たまるか LOG_FLUSH_MAX_AGE_SEC 経ったら append_rows 1回で送る
+    - 失敗したらそのシートだけ指数バックオフで待って再送（行は TurnLog に残る）
+    - 成功したら watermark を進める。複製はリースを持つ1プロセスだけが行うので、各プロセスは自分が submit した行が
+      watermark を越えたのを確かめてから on_flushed(rows) を呼ぶ（ターン単位のチェックポイント用）
+    append_rows が Sheets 側では成功したのに応答が失敗した場合だけ、再送で行が重複しうる（欠けることはない）。
+    """
+    def __init__(self, turn_log, max_rows=LOG_FLUSH_MAX_ROWS, max_age_sec=LOG_FLUSH_MAX_AGE_SEC, on_flushed=None):
+        self.turn_log = turn_log
+        self.max_rows = max_rows
+        self.max_age_sec = max_age_sec
+        self.on_flushed = on_flushed
+        self.failed_batches = 0            # 送信に失敗した回数（行は再送される）
+        self.replicated_rows = 0
+        self.sync_fallbacks = 0            # ローカル DB に書けず直接 Sheets に書いた回数
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._ws = {}                      # title -> Worksheet（submit で渡されたもの）
+        self._retry_at = {}                # title -> 次に送ってよい時刻
+        self._failures = {}                # title -> 連続失敗回数
+        self._flush_to = 0                 # この seq までは経過時間に関係なく送る
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._last_prune = 0.0
+        self._unconfirmed = []             # [(title, 最後の seq, rows)] このプロセスが書いてまだ複製を確認していない行
+        self._confirm_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="log-replicator", daemon=True)
+        self._thread.start()
+
+    def submit(self, ws, rows):
+        self._ws[ws.title] = ws
+        try:
+            seq = self.turn_log.append(ws.title, rows)
+        except sqlite3.Error:
+            self.sync_fallbacks += 1   # ディスクに書けないときは従来どおり直接書く
+            safe_append_rows_ws(ws, rows, report=False)
+            return
+        if self.on_flushed is not None:
+            with self._confirm_lock:
+                self._unconfirmed.append((ws.title, seq, rows))
+        self._wake.set()
+
+    def flush(self, wait=True, timeout=LOG_FLUSH_TIMEOUT_SEC):
+        """ここまでに書かれた行を送る。wait=True なら送り終わるまで待つ（Sheets が落ちていれば timeout で諦めて False）"""
+        target = self.turn_log.max_seq()
+        with self._cond:
+            self._flush_to = max(self._flush_to, target)
+        self._retry_at.clear()   # 明示的な flush ではバックオフ中のシートもすぐに試す
+        self._wake.set()
+        if not wait:
+            return True
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._replicated_upto(target):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 1.0))
+        self._confirm_replicated()   # 呼び出し元が続けて forget() してもチェックポイントが漏れないよう、ここで進める
+        return True
+
+    def _confirm_replicated(self):
+        """自分が書いた行のうち複製済みになった分を on_flushed に渡す（送ったのが別プロセスでも）"""
+        if self.on_flushed is None:
+            return
+        with self._confirm_lock:
+            if not self._unconfirmed:
+                return
+            done = self.turn_log.replicated_seqs()
+            flushed = [r for title, seq, rows in self._unconfirmed if seq <= done.get(title, 0) for r in rows]
+            self._unconfirmed = [u for u in self._unconfirmed if u[1] > done.get(u[0], 0)]
+        if not flushed:
+            return
+        try:
+            self.on_flushed(flushed)   # 確認できた分をまとめて1回（チェックポイントの書き込みは set_many 1回）
+        except Exception:
+            pass  # チェックポイントの失敗で複製を止めない（再開時に数ターン重複するだけ）
+
+    def _replicated_upto(self, target):
+        return all(first > target for _, first, _ in self.turn_log.pending().values())
+
+    def shutdown(self, timeout=60):
+        """送れる分は送ってからスレッドを止める（プロセス終了時）。残りは次回の起動時に送る"""
+        self.flush(wait=True, timeout=timeout)
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self.turn_log.release_lease(self._owner)
+
+    def stats(self):
+        pending = self.turn_log.pending()
+        oldest = min((o for _, _, o in pending.values()), default=None)
+        return {
+            "pending_rows": sum(n for n, _, _ in pending.values()),
+            "oldest_pending_sec": round(time.time() - oldest, 1) if oldest else 0.0,
+            "replicated_rows": self.replicated_rows,
+            "failed_batches": self.failed_batches,
+            "sync_fallbacks": self.sync_fallbacks,
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(LOG_REPLICATE_POLL_SEC)
+            self._wake.clear()
+            try:
+                if self.turn_log.acquire_lease(self._owner):
+                    self._replicate_due()
+                    if time.time() - self._last_prune > 3600:
+                        self.turn_log.prune()
+                        self._last_prune = time.time()
+                self._confirm_replicated()
+            except Exception:
+                pass  # ローカル DB の一時的なロックなど。次の周回でやり直す
+            with self._cond:
+                self._cond.notify_all()
+
+    def _replicate_due(self):
+        now = time.time()
+        for title, (n, first, oldest) in self.turn_log.pending().items():
+            if now < self._retry_at.get(title, 0):
+                continue
+            if n < self.max_rows and now - oldest < self.max_age_sec and first > self._flush_to:
+                continue
+            while True:
+                seqs, rows = self.turn_log.read_pending(title)
+                if not rows:
+                    break
+                try:
+                    ws = self._ws.get(title) or get_worksheet(title, header=LOG_HEADER)
+                    ws.append_rows(rows)
+                    sent = True
+                except Exception:
+                    sent = False   # APIError / 通信エラー。待ちはシートごとのバックオフで（このスレッドは止めない）
+                if not sent:
+                    self.failed_batches += 1
+                    self._failures[title] = self._failures.get(title, 0) + 1
+                    delay = min(LOG_RETRY_MAX_SEC, LOG_RETRY_BASE_SEC * 2 ** (self._failures[title] - 1))
+                    self._retry_at[title] = time.time() + delay
+                    break
+                self._failures.pop(title, None)
+                self.turn_log.mark_replicated(title, seqs[-1])
+                self.replicated_rows += len(rows)
+                if len(rows) < LOG_REPLICATE_BATCH_ROWS:
+                    break
+
+
+@st.cache_resource(show_spinner=False)
+def get_log_pipeline():
+    """プロセス共通のログ書き込み（ローカル WAL + Sheets への複製。終了時に送れる分は送る）"""
+    pipeline = LogReplicator(TurnLog(), on_flushed=get_turn_checkpointer().on_rows_flushed)
+    atexit.register(pipeline.shutdown)
+    return pipeline
+
+
+# --- Personality シートの共有ストア（Username で O(1) 参照） ---
+PROFILES_TTL_SEC = 60               # この間隔で新しい行だけを読み足す
+PROFILES_FULL_RESYNC_SEC = 30 * 60  # 全件の読み直しはたまにだけ（行の修正・削除の反映用）
+PROFILES_TAIL_CHUNK = 50            # 追記分を読む範囲（行数）
+
+class ProfileStore:
+    """
+    Personality シートをプロセス共通でキャッシュし、Username -> 行(dict) で引けるようにする。
+    - TTL 切れの再読込は1スレッドだけが行い、最後に読んだ行より後ろだけを範囲指定で読む
+      （responses_json を含む全件の読み直しは PROFILES_FULL_RESYNC_SEC ごと）
+    - 登録（ensure_personality_row / Personality Test）は書き込みと同時にキャッシュへ反映
+    - count() はシートの行数（条件の交互割当に使う）
+    """
+    def __init__(self, ws, ttl_sec=PROFILES_TTL_SEC, full_resync_sec=PROFILES_FULL_RESYNC_SEC):
+        self.ws = ws
+        self.ttl_sec = ttl_sec
+        self.full_resync_sec = full_resync_sec
+        self._lock = threading.Lock()           # _by_user / _count 用
+        self._refresh_lock = threading.Lock()   # 再読込は同時に1回だけ
+        self._by_user = {}
+        self._count = 0
+        self._header = []
+        self._last_row = 1         # 読み込み済みの最終行（1 = ヘッダのみ）
+        self._known_rows = set()   # 自分で書き込んで反映済みの行番号（tail read で二重に数えない）
+        self._ts = 0.0
+        self._full_ts = 0.0
+
+    def _ensure_fresh(self):
+        if time.time() - self._ts < self.ttl_sec:
+            return
+        with self._refresh_lock:
+            if time.time() - self._ts < self.ttl_sec:
+                return  # 待っている間に他スレッドが更新済み
+            full = not self._header or (time.time() - self._full_ts >= self.full_resync_sec)
+            self.refresh(full=full)
+
+    def _to_record(self, values):
+        values = list(values) + [""] * (len(self._header) - len(values))
+        return dict(zip(self._header, gspread.utils.numericise_all(values[:len(self._header)])))
+
+    def refresh(self, full=True):
+        if full:
+            values = self.ws.get_all_values()  # 全件 Read はここだけ
+            header, rows = (values[0], values[1:]) if values else ([], [])
+            with self._lock:
+                self._header = header
+                self._by_user = {}
+                for r in rows:
+                    rec = self._to_record(r)
+                    self._by_user.setdefault(rec.get("Username"), rec)  # 重複時は先頭行を優先
+                self._count = len(rows)
+                self._last_row = 1 + len(rows)
+                self._known_rows.clear()
+                self._ts = self._full_ts = time.time()
+            return
+
+        # 追記分だけを PROFILES_TAIL_CHUNK 行ずつ読む（返ってきた行数が満杯なら続きを読む）
+        # グリッドの外を指す範囲は 400 "exceeds grid limits" になるので、範囲はシートの行数（row_count）までに切る
+        ncols = len(self._header)
+        while True:
+            start = self._last_row + 1
+            if start > self.ws.row_count:
+                # 手元の row_count は他プロセスの追記を知らないので、グリッドが伸びていないか取り直す（read 1回）
+                self.ws = self.ws.spreadsheet.worksheet(self.ws.title)
+                if start > self.ws.row_count:
+                    break
+            end = min(start + PROFILES_TAIL_CHUNK - 1, self.ws.row_count)
+            rng = f"{gspread.utils.rowcol_to_a1(start, 1)}:{gspread.utils.rowcol_to_a1(end, ncols)}"
+            try:
+                rows = self.ws.get_values(rng)
+            except gspread.exceptions.APIError as e:
+                if e.code != 400:
+                    raise   # 429 などはこれまでどおり呼び出し元へ
+                # 行が削除された・gspread が append で row_count を多めに数えた など。シートを取り直して全件読む
+                self.ws = self.ws.spreadsheet.worksheet(self.ws.title)
+                self.refresh(full=True)
+                return
+            with self._lock:
+                for offset, r in enumerate(rows):
+                    row_no = start + offset
+                    if row_no in self._known_rows:
+                        self._known_rows.discard(row_no)
+                        continue
+                    rec = self._to_record(r)
+                    self._by_user.setdefault(rec.get("Username"), rec)
+                    self._count += 1
+                self._last_row += len(rows)
+            if len(rows) < PROFILES_TAIL_CHUNK:
+                break
+        self._ts = time.time()
+
+    def invalidate(self):
+        self._ts = 0.0
+
+    def sync(self):
+        """TTL を待たずに、他プロセスが追記した行を読み足す（複数プロセスで登録・交互割当をするとき用）"""
+        with self._refresh_lock:
+            self.refresh(full=not self._header)
+
+    def get(self, username):
+        self._ensure_fresh()
+        with self._lock:
+            return self._by_user.get(username)
+
+    def count(self):
+        self._ensure_fresh()
+        with self._lock:
+            return self._count
+
+    def append(self, row):
+        """シートに1行追加し、成功したらキャッシュにも反映（write-through）"""
+        self._ensure_fresh()
+        resp = safe_append(self.ws, row)
+        if resp is None:
+            return False
+        try:
+            updated = resp["updates"]["updatedRange"]            # 例: "Personality!A12:I12"
+            row_no = int(re.search(r"!?[A-Z]+(\d+)", updated.split("!")[-1]).group(1))
+        except Exception:
+            self.invalidate()  # 行番号が分からなければ次回の tail read に任せる
+            return True
+        with self._lock:
+            self._by_user.setdefault(row[0], dict(zip(self._header, row)))
+            self._count += 1
+            if row_no > self._last_row:
+                self._known_rows.add(row_no)
+        return True
+
+
+@st.cache_resource(show_spinner=False)
+def get_profile_store():
+    return ProfileStore(get_worksheet("Personality"))
+
+def ensure_personality_row(username: str, session_id: str, experiment_condition: str, profile_dict: dict, responses_json: str = "{}"):
+    """
+    Personalityに同名ユーザーが無ければ1回だけ登録する。
+    """
+    store = get_profile_store()
+    if store.get(username) is not None:
+        return  # 既に登録済み
+
+    row = [
+        username,
+        session_id,
+        experiment_condition,
+        int(profile_dict.get("Extraversion", 50)),
+        int(profile_dict.get("Agreeableness", 50)),
+        int(profile_dict.get("Conscientiousness", 50)),
+        int(profile_dict.get("Emotional Stability", 50)),
+        int(profile_dict.get("Openness", 50)),
+        responses_json,
+    ]
+    store.append(row)
+
+
+def log_chat_to_sheet(ws, session_id, username, user_msg, ai_msg,
+                      timestamp, experiment, matched_bool,
+                      turn, phase, group_id, user_index,
+                      tone_e=None, tone_a=None, tone_c=None, tone_es=None, tone_o=None):
+    matched_str = "Matched" if matched_bool else "NoMatch"
+    group_user = f"Group {group_id} Simulated User {user_index}"
+    onehot = [1 if (i+1) == int(group_id) else 0 for i in range(10)]
+
+    row_tail = [*onehot, tone_e, tone_a, tone_c, tone_es, tone_o]
+
+    # User/AI の2行はローカルの WAL に書き、LOGS_* へはバックグラウンドでまとめて append_rows
+    get_log_pipeline().submit(ws, [
+        [
+            session_id, username, "User", user_msg, timestamp,
+            experiment, matched_str, turn, phase,
+            group_id, user_index, group_user, *row_tail
+        ],
+        [
+            session_id, username, "AI", ai_msg, timestamp,
+            experiment, matched_str, turn, phase,
+            group_id, user_index, group_user, *row_tail
+        ],
+    ])
+
+
+# === Google Sheets 安全書き込み ===
+def safe_append(sheet, row, retries=3, delay=2):
+    for i in range(retries):
+        try:
+            return sheet.append_row(row)  # API のレスポンス（updatedRange を含む）
+        except gspread.exceptions.APIError:
+            time.sleep(delay * (i + 1))
+    st.error("Failed to log data after multiple retries.")
+    return None
+
+def get_profile(user):
+    return get_profile_store().get(user)
+
+
+
+#Penley & Tomaka 2002, Carver & Connor-Smith 2010, Stewart 2000, Frontiers 2023
+# === Big Fiveトーン + 複合パターン対応 ===
+def determine_tone(profile, match=True, rng=None):
+    def clamp01(x): return max(0, min(100, int(x)))
+
+    def flip(value): 
+        v = clamp01(value)
+        return 100 - v
+
+    def adjusted(trait): 
+        v = int(profile.get(trait, 50))
+        return v if match else flip(v)
+
+    ex = adjusted("Extraversion")
+    ag = adjusted("Agreeableness")
+    co = adjusted("Conscientiousness")
+    es = adjusted("Emotional Stability")
+    op = adjusted("Openness")
+
+    tone = "cheerful and engaging" if ex >= 60 else "calm and measured"
+    empathy = "warm and supportive" if ag >= 60 else "matter-of-fact but polite"
+    style = "clear and structured" if co >= 60 else "casual and flexible"
+    emotional = "steady and reassuring" if es >= 60 else "gentle and calming"
+    creativity = "curious and imaginative" if op >= 60 else "practical and simple"
+
+    suggestions_map = []
+    if es <= 40 and co <= 40:
+        suggestions_map.append("Try breaking big tasks into small steps and reframe stress as a challenge.")
+    if ex >= 60 and co <= 40:
+        suggestions_map.append("Plan a fun social activity that gives you energy but adds a little structure.")
+    if es <= 40 and ex <= 40:
+        suggestions_map.append("Express your feelings safely, like journaling, or try a mindfulness break.")
+    if ex >= 60 and co >= 60:
+        suggestions_map.append("Set a short-term goal and tackle it with a friend to stay motivated.")
+    if ag >= 60:
+        suggestions_map.append("Reach out to a supportive friend or help someone else—it can lift your mood.")
+    if op >= 60:
+        suggestions_map.append("Try a creative outlet like art or music, or explore a new hobby.")
+
+    if not suggestions_map:
+        suggestions_map.append("Offer practical coping ideas based on their personality.")
+    special_instruction = " ".join((rng or random).sample(suggestions_map, min(2, len(suggestions_map))))
+
+    return {
+        "tone": tone,
+        "empathy": empathy,
+        "style": style,
+        "emotional": emotional,
+        "creativity": creativity,
+        "special_instruction": special_instruction,
+        # ★ 追加：実際に使った値
+        "used_traits": {"E": ex, "A": ag, "C": co, "ES": es, "O": op}
+    }
+
+
+def tone_for_turn(profile, exp_cond, match, rng=None, default=""):
+    """
+    条件に応じたトーン指示と Tone_* 用の値を返す。
+    Fixed Empathy は固定文、それ以外は determine_tone（match でマッチ／ミスマッチ）。
+    """
+    if exp_cond == "Fixed Empathy":
+        used = {
+            "E": profile.get("Extraversion", default),
+            "A": profile.get("Agreeableness", default),
+            "C": profile.get("Conscientiousness", default),
+            "ES": profile.get("Emotional Stability", default),
+            "O": profile.get("Openness", default),
+        }
+        return "Respond in a calm, supportive tone, like a counselor.", used
+    tone_data = determine_tone(profile, match=match, rng=rng)
+    tone_instruction = (
+        f"Respond in a {tone_data['tone']}, {tone_data['empathy']} way. "
+        f"Keep tone {tone_data['emotional']} and include {tone_data['creativity']} ideas. "
+        f"{tone_data['special_instruction']}"
+    )
+    return tone_instruction, tone_data["used_traits"]
+
+
+# ==== ここから Big5Chat ベースの擬似ユーザー生成 & 自動会話シミュレーション ==== #
+
+BIG5_PATH = "data/big5_chat/big5_chat_dataset_prepped.csv"  # アップロード済みのパスに合わせて
+BIG5_CACHE_DIR = "data/big5_chat/.cache"   # 前処理済み（列指向）データの置き場所
+BIG5_CACHE_VERSION = 5                     # 前処理の中身を変えたら上げる（古いキャッシュを無視）
+BIG5_CSV_CHUNK_ROWS = 50_000               # CSV はこの行数ずつ読んで前処理する（ピークメモリを抑える）
+
+BIG5_TRAITS = ["Extraversion","Agreeableness","Conscientiousness","Emotional Stability","Openness"]
+TRAIT_MAP = {
+    "e":"Extraversion","extraversion":"Extraversion",
+    "a":"Agreeableness","agreeableness":"Agreeableness",
+    "c":"Conscientiousness","conscientiousness":"Conscientiousness",
+    "n":"Emotional Stability","neuroticism":"Emotional Stability","emotional stability":"Emotional Stability",
+    "o":"Openness","openness":"Openness",
+}
+LEVEL_MAP = {"high":80, "medium":60, "mid":60, "low":20}   # 該当なしは 50
+
+def load_big5chat():
+    """
+    前処理済みの Big5Chat を返す（プロセス内で共有。呼び出し側で書き換えないこと）。
+    初回だけ CSV を解析して Feather（Arrow, 無圧縮）に保存し、以降はそれを memory-map で読む。
+    キャッシュはソース CSV のハッシュで区別するので、CSV を差し替えれば作り直される。
+    """
+    return _load_big5chat_cached(*big5_dataset_key())
+
+def big5_dataset_key():
+    """(パス, サイズ, 更新時刻)。データセット由来の共有リソースのキャッシュキーに使う"""
+    stat = os.stat(BIG5_PATH)
+    return BIG5_PATH, stat.st_size, stat.st_mtime
+
+def _file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def big5_dataset_digest(path, size, mtime):
+    """ソース CSV の sha256（引数は big5_dataset_key()。size / mtime はキャッシュキー用）"""
+    return _file_sha256(path)
+
+@st.cache_resource(show_spinner=False)
+def _load_big5chat_cached(path, size, mtime):
+    # size / mtime はキャッシュキー用（ファイルが更新されたらハッシュから計算し直す）
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    digest = big5_dataset_digest(path, size, mtime)
+    cache_path = os.path.join(BIG5_CACHE_DIR, f"big5chat_v{BIG5_CACHE_VERSION}_{digest[:16]}.feather")
+    if not os.path.exists(cache_path):
+        parsed = _parse_big5chat_csv(path)
+        os.makedirs(BIG5_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+        feather.write_feather(parsed, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, cache_path)   # 途中で落ちても壊れたキャッシュを残さない
+
+    table = feather.read_table(cache_path, memory_map=True)
+    # 文字列列は Arrow のまま（mmap 上のバッファを参照）、数値列は通常の numpy 列
+    def _types_mapper(pa_type):
+        if pa.types.is_string(pa_type) or pa.types.is_large_string(pa_type):
+            return pd.ArrowDtype(pa_type)
+        return None
+    return table.to_pandas(types_mapper=_types_mapper)
+
+TEXT_CANDIDATES = [
+    "train_input", "narrative", "literal",
+    "text", "utterance", "message", "user_text", "content", "sentence",
+]
+
+def _read_big5chat_header(path):
+    """(列名, read_csv に渡す読み込みオプション)。文字コードや区切りの揺れはここで判定する"""
+    try:
+        return list(pd.read_csv(path, nrows=0).columns), {}
+    except UnicodeDecodeError:
+        opts = {"encoding": "utf-8-sig"}
+    except Exception:
+        opts = {"sep": None, "engine": "python"}
+    return list(pd.read_csv(path, nrows=0, **opts).columns), opts
+
+def _parse_big5chat_csv(path):
+    """
+    CSV を BIG5_CSV_CHUNK_ROWS 行ずつ読んで前処理し、pyarrow.Table（text / Big5 5列 int8 / crisis）にまとめる。
+    読むのは発話列・trait/level・Big5 列だけ（trait/level は category で読み、Big5 スコアに反映したら捨てる）。
+    チャンクごとに Arrow 配列へ変換するので、Python 文字列として同時に持つのは1チャンク分だけ。
+    """
+    import pyarrow as pa
+
+    # 1) ヘッダだけ読んで、使う列と読み込みオプションを決める
+    raw_columns, read_opts = _read_big5chat_header(path)
+    columns = {c.strip(): c for c in raw_columns}   # 前後の空白を除いた列名 -> 元の列名
+
+    # 2) ユーザー発話列を推定して 'text' に統一
+    text_col = next((c for c in TEXT_CANDIDATES if c in columns), None)
+    if text_col is None:
+        st.error(f"発話列が見つかりません。候補={TEXT_CANDIDATES} / 実列={list(columns)}")
+        st.stop()
+    wanted = [text_col] + [c for c in ("trait", "level", *BIG5_TRAITS) if c in columns]
+    dtypes = {columns[text_col]: str}
+    dtypes.update({columns[c]: "category" for c in ("trait", "level") if c in columns})
+
+    schema = pa.schema([("text", pa.string())] + [(t, pa.int8()) for t in BIG5_TRAITS] + [("crisis", pa.bool_())])
+    tables = []
+    reader = pd.read_csv(path, usecols=[columns[c] for c in wanted], dtype=dtypes,
+                         chunksize=BIG5_CSV_CHUNK_ROWS, **read_opts)
+    for chunk in reader:
+        chunk.columns = [c.strip() for c in chunk.columns]
+        if text_col != "text":
+            chunk = chunk.rename(columns={text_col: "text"})
+
+        # 3) Big5 列を準備（無ければ 50 で埋める）
+        for t in BIG5_TRAITS:
+            if t not in chunk.columns:
+                chunk[t] = 50
+
+        # 4) trait/level がある場合は簡易に数値化して該当特性のみ上書き
+        chunk = normalize_trait_levels(chunk)
+
+        # 5) クリーニング（空の発話を落とし、スコアは 0–100 の int8 に）
+        text = chunk["text"].astype(str).str.strip()
+        keep = (text.str.len() > 0).to_numpy()
+        text = text[keep]
+        arrays = [pa.array(text.to_numpy(), type=pa.string())]
+        for t in BIG5_TRAITS:
+            score = pd.to_numeric(chunk[t], errors="coerce").fillna(50).clip(0, 100).astype(int)
+            arrays.append(pa.array(score.to_numpy()[keep].astype(np.int8)))
+
+        # 6) 危機対応の定型文になる（API を呼ばない）行を事前に判定
+        arrays.append(pa.array(crisis_flags(text)))
+        tables.append(pa.Table.from_arrays(arrays, schema=schema))
+
+    return pa.concat_tables(tables) if tables else schema.empty_table()
+
+def normalize_trait_levels(df):
+    """
+    trait/level 列（例: trait="o", level="high"）から該当する Big5 列だけをスコアで上書きする。
+    行ごとの df.loc ではなく特性ごとの一括代入（5回）で処理する。
+    行をまたぐ処理はしないので、read_csv(chunksize=...) のチャンクにもそのまま使える。
+    """
+    if "trait" not in df.columns:
+        return df
+    tseries = _map_labels(df["trait"], TRAIT_MAP)
+    if "level" in df.columns:
+        lvalues = _map_labels(df["level"], LEVEL_MAP).fillna(50).astype(int).to_numpy()
+    else:
+        lvalues = np.full(len(df), 50)
+    for col in BIG5_TRAITS:
+        if col not in df.columns:
+            continue
+        mask = (tseries == col).to_numpy()
+        if mask.any():
+            df[col] = np.where(mask, lvalues, df[col].to_numpy())
+    return df
+
+def _map_labels(series, mapping):
+    """ラベル列を strip / lower してから mapping で変換（category 列はカテゴリごとに1回だけ変換する）"""
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return series.astype(str).str.strip().str.lower().map(mapping)
+    mapped = pd.Series(series.cat.categories.astype(str)).str.strip().str.lower().map(mapping).to_numpy(dtype=object)
+    codes = series.cat.codes.to_numpy()
+    out = np.full(len(series), np.nan, dtype=object)
+    out[codes >= 0] = mapped[codes[codes >= 0]]
+    return pd.Series(out, index=series.index)
+
+DISJOINT_MAX_USERS_PER_GROUP = 65   # 1クラスタから作る擬似ユーザー数の上限
+DISJOINT_PLAN_VERSION = 2           # バッチの割り当て方を変えたら上げる（古いプランファイルを無視）
+
+
+class DatasetTexts(Sequence):
+    """
+    行番号で指した発話列のビュー。文字列は取り出した時点で共有データセットから読む（コピーを持たない）。
+    run_simulation_for_user_slow の user_inputs にそのまま渡せる（len / 添字 / スライス / 反復）。
+    """
+    def __init__(self, text, row_ids):
+        self._text = text            # load_big5chat()["text"]（共有）
+        self._row_ids = row_ids      # int32 の行番号
+
+    def __len__(self):
+        return len(self._row_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return DatasetTexts(self._text, self._row_ids[i])
+        return str(self._text.iloc[int(self._row_ids[i])])
+
+
+class DisjointPlan:
+    """
+    build_disjoint_batches の結果。バッチ i は row_ids[i]（データセットの行番号 batch_size 個）と小さなメタデータだけ。
+    プロセス内で共有する（get_disjoint_plan）ので、管理画面のセッションごとに本文を複製しない。
+    """
+    ARRAYS = ("row_ids", "group_ids", "user_indices", "centers", "crisis")
+
+    def __init__(self, row_ids, group_ids, user_indices, centers, crisis, plan_id=""):
+        self.row_ids = row_ids            # (バッチ数, batch_size) int32
+        self.group_ids = group_ids        # (バッチ数,) int32  1..G
+        self.user_indices = user_indices  # (バッチ数,) int32  1..65
+        self.centers = centers            # (バッチ数, 5) int16  BIG5_TRAITS の順
+        self.crisis = crisis              # (バッチ数, batch_size) bool
+        self.api_calls = (~crisis).sum(axis=1).astype(np.int32)
+        self.plan_id = plan_id            # 保存したプランファイル名（キャッシュのキー）
+        # バッチの中身（行番号の並び）だけのハッシュ。SIM_META の DISJOINT_PLAN と照合する
+        # （前処理のバージョンが上がってプランを作り直しても、並びが同じなら一致する）
+        self.fingerprint = "rows_" + hashlib.sha256(np.ascontiguousarray(row_ids, dtype=np.int32).tobytes()).hexdigest()[:24]
+
+    def save(self, path):
+        """無圧縮 .npz に保存（一時ファイル → rename なので途中で落ちても壊れたファイルを残さない）"""
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, plan_id=""):
+        with np.load(path) as data:
+            return cls(*(data[name] for name in cls.ARRAYS), plan_id=plan_id)
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    @property
+    def batch_size(self):
+        return self.row_ids.shape[1]
+
+    def batch(self, i):
+        """
+        バッチ i のメタデータ（本文は含まない）:
+        {'group_id', 'user_index', 'center': {...Big5}, 'row_ids', 'crisis': bool 配列, 'api_calls': 危機対応以外のターン数}
+        """
+        return {
+            "group_id": int(self.group_ids[i]),
+            "user_index": int(self.user_indices[i]),
+            "center": {t: int(v) for t, v in zip(BIG5_TRAITS, self.centers[i])},
+            "row_ids": self.row_ids[i],
+            "crisis": self.crisis[i],
+            "api_calls": int(self.api_calls[i]),
+        }
+
+    def texts(self, df, i):
+        """バッチ i の発話（DatasetTexts。実際の文字列はターン実行時に読む）"""
+        return DatasetTexts(df["text"], self.row_ids[i])
+
+    def api_budget(self, start, end):
+        """バッチ start..end-1 を実行したときの API 呼び出し数（危機対応のターンは含まない）"""
+        return int(self.api_calls[start:end].sum())
+
+
+def build_disjoint_batches(df: pd.DataFrame, batch_size: int = 60, seed: int = 42,
+                           max_users_per_group: int = DISJOINT_MAX_USERS_PER_GROUP):
+    """
+    Big5 の完全一致クラスタごとに行をシャッフルし、60件ずつ“重複ゼロ”のバッチに分割（1クラスタ最大 max_users_per_group 人）。
+    返り値: DisjointPlan（バッチごとの行番号とメタデータ。本文は DisjointPlan.texts で必要な時に読む）
+    numpy の一括処理: seed 固定の順列で行を並べ替えてから特性タプルで安定ソート
+    → クラスタ内はランダム順に並ぶので、各クラスタの先頭から batch_size の倍数だけ取って reshape する。
+    group_id は特性タプルの昇順（バッチが作れないクラスタも番号を1つ使う）。
+    """
+    n_traits = len(BIG5_TRAITS)
+    # 特性の整数化（安全側）。df は load_big5chat の共有データなので書き換えずに配列側で行う
+    values = np.empty((len(df), n_traits), dtype=np.int64)
+    for j, col in enumerate(BIG5_TRAITS):
+        s = df[col]
+        if not pd.api.types.is_integer_dtype(s.dtype):
+            s = pd.to_numeric(s, errors="coerce").fillna(50).astype(int)
+        values[:, j] = s.to_numpy()
+    crisis = df["crisis"].to_numpy(dtype=bool) if "crisis" in df.columns else crisis_flags(df["text"])
+
+    # seed 固定の順列で並べてから特性タプルで安定ソート → クラスタ内はランダム順のまま残る
+    perm = np.random.default_rng(seed).permutation(len(df))
+    order = perm[np.argsort(_trait_tuple_codes(values[perm]), kind="stable")]
+    sorted_values = values[order]
+
+    # クラスタの境界と人数（何人分のバッチが作れるか）
+    if len(order):
+        is_start = np.concatenate([[True], np.any(sorted_values[1:] != sorted_values[:-1], axis=1)])
+    else:
+        is_start = np.zeros(0, dtype=bool)
+    starts = np.flatnonzero(is_start)
+    counts = np.diff(np.append(starts, len(order)))
+    n_users = np.minimum(counts // batch_size, max_users_per_group)
+
+    # 各クラスタの先頭 n_users * batch_size 行だけ残す（余りと上限超過分は捨てる）
+    group_of_row = np.cumsum(is_start) - 1
+    pos_in_group = np.arange(len(order)) - starts[group_of_row]
+    keep = pos_in_group < (n_users * batch_size)[group_of_row]
+    row_ids = order[keep].astype(np.int32).reshape(-1, batch_size)
+
+    has_users = n_users > 0
+    group_ids = np.repeat(np.flatnonzero(has_users) + 1, n_users[has_users]).astype(np.int32)
+    first_batch = np.repeat(np.cumsum(n_users[has_users]) - n_users[has_users], n_users[has_users])
+    user_indices = (np.arange(len(row_ids)) - first_batch + 1).astype(np.int32)
+    centers = np.repeat(sorted_values[starts[has_users]], n_users[has_users], axis=0).astype(np.int16)
+    return DisjointPlan(row_ids, group_ids, user_indices, centers, crisis[row_ids])
+
+
+def disjoint_plan_conflict(plan, ptr, saved):
+    """
+    DISJOINT_PTR（ptr）は記録したときのプランの並びを指している。ptr > 0 なのに記録されたプラン（saved）が
+    今のプランと違う・記録が無いときは説明を返す（続きのユーザーが使用済みの発話を受け取りうる）。問題なければ None。
+    """
+    if ptr <= 0 or saved == plan.fingerprint:
+        return None
+    return (f"DISJOINT_PTR={ptr} was recorded with batch plan {saved or '(unrecorded)'}, "
+            f"but the current plan is {plan.fingerprint}. Remaining users may reuse texts from finished users.")
+
+
+def _trait_tuple_codes(values):
+    """
+    (行数, 5) の整数配列を、特性タプルの辞書式順序と同じ順になる int64 の1列にする（混合基数）。
+    値の幅が大きすぎて int64 に収まらないときは、タプルの順位（np.unique）で代用する。
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    lo = values.min(axis=0)
+    spans = values.max(axis=0) - lo + 1
+    if np.prod(spans.astype(float)) >= 2.0 ** 62:
+        return np.unique(values, axis=0, return_inverse=True)[1].ravel()
+    codes = np.zeros(len(values), dtype=np.int64)
+    for j in range(values.shape[1]):
+        codes = codes * spans[j] + (values[:, j] - lo[j])
+    return codes
+
+
+@st.cache_resource(show_spinner=False)
+def get_disjoint_plan(_df, dataset_key, batch_size=60, seed=42, max_users_per_group=DISJOINT_MAX_USERS_PER_GROUP):
+    """
+    load_big5chat の共有データに対する DisjointPlan（dataset_key = big5_dataset_key()）。全セッションで1つ。
+    (データセットのハッシュ, batch_size, 上限, seed) ごとに BIG5_CACHE_DIR に保存し、再起動後はそれを読むだけ。
+    """
+    digest = big5_dataset_digest(*dataset_key)
+    plan_id = (f"disjoint_v{DISJOINT_PLAN_VERSION}.{BIG5_CACHE_VERSION}_{digest[:16]}"
+               f"_b{batch_size}_c{max_users_per_group}_s{seed}")
+    path = os.path.join(BIG5_CACHE_DIR, f"{plan_id}.npz")
+    if os.path.exists(path):
+        try:
+            return DisjointPlan.load(path, plan_id=plan_id)
+        except (OSError, ValueError, KeyError):
+            pass   # 壊れたファイルは作り直す
+    plan = build_disjoint_batches(_df, batch_size=batch_size, seed=seed, max_users_per_group=max_users_per_group)
+    plan.plan_id = plan_id
+    os.makedirs(BIG5_CACHE_DIR, exist_ok=True)
+    plan.save(path)
+    return plan
+
+
+def to_bins(score, step=10):
+    """0–100 のスコアを step 幅（±10 など）でビン化（例: step=10 なら 0,10,20,...）"""
+    try:
+        s = float(score)
+    except:
+        s = 50.0
+    s = max(0, min(100, s))
+    return int(round(s/step)*step)
+
+class TraitIndex:
+    """
+    Big5 の5特性タプル（完全一致）ごとに行番号をまとめたバケット索引。
+    Big5Chat の特性値は数種類（20/50/60/80 など）しかないのでバケット数は小さく、
+    ±window の箱検索はバケットの中心値だけを比べて該当バケットの行番号を返す（全行スキャン・コピーなし）。
+    """
+    def __init__(self, df):
+        values = df[BIG5_TRAITS].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+        keys, inverse, counts = np.unique(values, axis=0, return_inverse=True, return_counts=True)
+        self.keys = keys                                            # (バケット数, 5)
+        self.row_ids = np.argsort(inverse.ravel(), kind="stable")   # バケット順に並べた行番号
+        self.bounds = np.concatenate([[0], np.cumsum(counts)])      # バケット i = row_ids[bounds[i]:bounds[i+1]]
+
+    def query(self, center, window=10):
+        """
+        center: {'Extraversion': 70,...} のような中心値
+        window: 各特性 ±window（両端含む）に入る行の行番号（元の行順）を返す
+        """
+        c = np.array([float(center[t]) for t in BIG5_TRAITS])
+        hit = np.flatnonzero(np.all(np.abs(self.keys - c) <= window, axis=1))  # NaN を含むバケットは常に外れる
+        if len(hit) == 0:
+            return np.empty(0, dtype=np.int64)
+        ids = np.concatenate([self.row_ids[self.bounds[b]:self.bounds[b + 1]] for b in hit])
+        ids.sort()
+        return ids
+
+
+@st.cache_resource(show_spinner=False)
+def get_trait_index(_df, dataset_key):
+    """load_big5chat の共有データに対する索引（dataset_key = big5_dataset_key()）"""
+    return TraitIndex(_df)
+
+def build_profile_from_center(center):
+    """
+    center（各特性 0–100）から、シートの Personality と同形式の dict を作る
+    """
+    return {
+        "Extraversion": int(center.get("Extraversion", 50)),
+        "Agreeableness": int(center.get("Agreeableness", 50)),
+        "Conscientiousness": int(center.get("Conscientiousness", 50)),
+        "Emotional Stability": int(center.get("Emotional Stability", 50)),
+        "Openness": int(center.get("Openness", 50)),
+        # 以降は Chat 時に参照されないが、関数互換のためキー揃え
+        "Username": "",
+        "ExperimentCondition": "Personalized Empathy",
+    }
+
+def sample_group_row_ids(row_ids, min_count=60, seed=0):
+    """
+    類似スコア群の行番号 (row_ids, TraitIndex.query の結果) から、ユーザー入力にする行番号を min_count 個選ぶ。
+    足りない場合はループして補う。並びは従来の gdf.sample(frac=1, random_state=seed) と同じ。
+    """
+    order = np.asarray(row_ids)[np.random.RandomState(seed).permutation(len(row_ids))]
+    if len(order) < min_count:
+        order = np.resize(order, min_count)  # 足りなければループして補完
+    return order[:min_count]
+
+def make_user_inputs_from_group(df, row_ids, min_count=60, seed=0):
+    """sample_group_row_ids で選んだ行のユーザー入力（text）のリスト"""
+    return df["text"].take(sample_group_row_ids(row_ids, min_count, seed)).astype(str).tolist()
+
+def build_sim_turn_prompt(profile_dict, exp_cond, match, chat_history, ux, rng=None):
+    """
+    シミュレーション1ターン分のプロンプトと Tone_* 用の値を返す。
+    rng を固定すれば同じ入力から同じプロンプトになる（応答キャッシュのキー／ログからの再構成用）。
+    """
+    tone_instruction, used = tone_for_turn(profile_dict, exp_cond, match, rng=rng, default=50)
+    return prompts.build_turn_prompt(profile_dict, tone_instruction, chat_history, ux), used
+
+def run_simulation_for_user_slow(username, profile_dict, user_inputs, session_id, flip_after=30, delay_sec=0,
+                                 experiment_condition=None, limiter=None, on_turn=None, cache=None, batcher=None,
+                                 resume=False, crisis=None):
+    """
+    擬似ユーザー1人分の会話（ターンは順番通り）。
+    experiment_condition / limiter / on_turn を渡せばワーカースレッドからも呼べる（st.* を触らない）。
+    delay_sec: ターン間の待ち時間（このユーザー内）
+    cache: ResponseCache を渡すと同じプロンプトは API を呼ばずに再生する
+    batcher: GenerationBatcher を渡すと他のユーザーのプロンプトとまとめて送る
+    resume: True なら session_id のチェックポイント（SIM_META + ローカル WAL）があれば、ログ済みのターンは飛ばして
+            次のターンから続ける（条件・直近の文脈はチェックポイントのものを使う）。同じ名前の別セッションは引き継がない。
+            呼び出し元は登録済みの SessionID を渡し、other_sessions() で名前の衝突を確かめてから True にする
+    user_inputs: 発話のリスト、または DatasetTexts（ターンごとにデータセットから読む）
+    crisis: user_inputs と同じ長さの事前判定（DisjointPlan.batch(i)["crisis"]）。無ければターンごとに判定
+    """
+    chat_history = []
+    rng = random.Random(username)  # トーンの選び方をユーザーごとに固定（再実行で同じプロンプトになる）
+    if on_turn is None:
+        progress = st.empty()
+        on_turn = lambda t, n: progress.text(f"{username}: {t}/{n} processed...")
+    exp_cond = experiment_condition or st.session_state.get("experiment_condition", "Personalized Empathy")
+
+    start_turn = 1
+    ckp = resume_point(username, session_id) if resume else None
+    if ckp is not None:
+        if ckp["last_turn"] >= len(user_inputs):
+            on_turn(len(user_inputs), len(user_inputs))
+            return  # 全ターン記録済み
+        exp_cond = ckp["mode"] or exp_cond
+        chat_history = list(ckp["history"])
+        start_turn = ckp["last_turn"] + 1
+        for t in range(1, start_turn):
+            build_sim_turn_prompt(profile_dict, exp_cond, t >= flip_after, [], "", rng=rng)  # rng を中断前と同じ位置まで進める
+    checkpoints = get_turn_checkpointer() if resume else None
+
+    for turn_index, ux in enumerate(user_inputs[start_turn - 1:], start=start_turn):
+        if turn_index > start_turn and delay_sec > 0:
+            time.sleep(delay_sec)
+        match = (turn_index >= flip_after)
+
+        # ログ用フラグと Phase（Fixedは常にNoMatch扱い／Phaseは空）
+        matched_for_log = (match if exp_cond != "Fixed Empathy" else False)
+        phase = (("Matched" if match else "NoMatch") if exp_cond != "Fixed Empathy" else "")
+
+        prompt, used = build_sim_turn_prompt(profile_dict, exp_cond, match, chat_history, ux, rng=rng)
+
+        crisis_msg = (CRISIS_REPLY if crisis[turn_index - 1] else None) if crisis is not None else handle_crisis(ux)
+        if crisis_msg:
+            ai_reply = crisis_msg
+        elif batcher is not None:
+            ai_reply = batcher.generate(prompt, cache=cache, conversation_id=session_id).text or "[Simulation] No response."
+        else:
+            ai_reply = call_api(prompt, limiter=limiter, cache=cache, conversation_id=session_id) or "[Simulation] No response."
+
+        chat_history.extend([{"role":"User","content":ux},{"role":"AI","content":ai_reply}])
+        if checkpoints is not None:
+            # ログ行が書き込まれた時点でこのターンをチェックポイントにする（書き込み自体はログの flush 時にまとめて）
+            checkpoints.note(username, session_id, turn_index, exp_cond, chat_history, committed=start_turn - 1)
+
+        # --- ログ書き込み（正しい順序/引数で1回だけ） ---
+        ws = get_user_log_ws_cached(username, matched_for_log, experiment_condition=exp_cond)
+        ts_iso = datetime.utcnow().isoformat()
+
+        # "Group {k} Simulated User {n}" から抽出
+        try:
+            parts = username.split()
+            group_id = int(parts[1]); user_index = int(parts[-1])
+        except Exception:
+            group_id = 0; user_index = 0
+
+        log_chat_to_sheet(
+            ws,                 # 1) ws
+            session_id,         # 2) SessionID（呼び出し元で生成）
+            username,           # 3) Username
+            ux,                 # 4) User message
+            ai_reply,           # 5) AI message
+            ts_iso,             # 6) Timestamp
+            exp_cond,           # 7) ExperimentCondition
+            matched_for_log,    # 8) MatchedMode(bool)
+            turn_index,         # 9) Turn (1..60)
+            phase,              # 10) Phase
+            group_id,           # 11) GroupID
+            user_index,          # 12) UserIndex
+            used.get("E",""), used.get("A",""), used.get("C",""), used.get("ES",""), used.get("O","")
+        )
+
+        on_turn(turn_index, len(user_inputs))
+
+    # ユーザー（セッション）終了時に残りのログを書き出す（チェックポイントも最終ターンまで進む）
+    get_log_pipeline().flush()
+    if checkpoints is not None:
+        checkpoints.forget(username, session_id)
+
+
+# === 同時実行（複数の擬似ユーザーを並列に） ===
+class RateLimiter:
+    """全スレッド共通の API 呼び出し間隔（requests_per_sec 以下に抑える）"""
+    def __init__(self, requests_per_sec):
+        self.interval = 1.0 / requests_per_sec if requests_per_sec and requests_per_sec > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_sec = self._next - now
+            self._next = max(now, self._next) + self.interval   # 次の枠を予約してから待つ
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+
+
+def run_simulations_concurrently(jobs, max_workers=4, requests_per_sec=1.0, delay_sec=0, on_done=None, cache=None,
+                                 batch_size=0, batch_wait_sec=None):
+    """
+    jobs: run_simulation_for_user_slow の引数 dict を順に返すイテラブル（generator 可）。
+          次のジョブは空きが出たときに（メインスレッドで）取り出すので、登録処理も少しずつ進む。
+    ユーザー単位でスレッドプールに投げ、ユーザー内のターンは順番通りに実行する。
+    API 呼び出しは全スレッド共通の RateLimiter で requests_per_sec 以下に抑える。
+    batch_size > 1 なら各ユーザーの現在ターンのプロンプトを GenerationBatcher でまとめて送る。
+    on_done(index, job, error) は完了順にメインスレッドで呼ばれる（error は成功時 None）。
+    """
+    limiter = RateLimiter(requests_per_sec)
+    batcher = None
+    if batch_size and batch_size > 1:
+        batcher = GenerationBatcher(get_generation_client(), max_batch_size=batch_size, limiter=limiter,
+                                    max_wait_sec=GEN_BATCH_MAX_WAIT_SEC if batch_wait_sec is None else batch_wait_sec)
+    progress = {}          # username -> "t/n"（ワーカーが書き、メインスレッドが表示）
+    board = st.empty()
+    jobs = iter(enumerate(jobs))
+
+    def _run(job):
+        username = job["username"]
+        run_simulation_for_user_slow(
+            **job, delay_sec=delay_sec, limiter=limiter, cache=cache, batcher=batcher,
+            on_turn=lambda t, n: progress.__setitem__(username, f"{t}/{n}"),
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sim") as pool:
+        running = {}
+        while True:
+            while len(running) < max_workers:
+                nxt = next(jobs, None)
+                if nxt is None:
+                    break
+                i, job = nxt
+                progress[job["username"]] = "queued"
+                running[pool.submit(_run, job)] = (i, job)
+            if not running:
+                break
+            done, _ = wait(running, timeout=1.0, return_when=FIRST_COMPLETED)
+            board.text("\n".join(f"{u}: {p}" for u, p in progress.items() if p != "done"))
+            for f in done:
+                i, job = running.pop(f)
+                progress[job["username"]] = "done"
+                if on_done:
+                    on_done(i, job, f.exception())
+    board.empty()
+    if batcher is not None:
+        batcher.close()
+
+
+# === 危機対応 ===
+CRISIS_KEYWORDS = ["suicide", "kill myself", "end my life", "self-harm"]
+CRISIS_REPLY = "I'm really sorry you're feeling this way. You're not alone. Please contact someone you trust or a hotline."
+# 全角・合字は NFKC、大小文字は casefold、各種ダッシュ/アポストロフィは ASCII に寄せてから照合
+_CRISIS_TRANSLATE = str.maketrans({c: "-" for c in "\u2010\u2011\u2012\u2013\u2014\u2015\u2212\ufe63\uff0d"} |
+                                  {c: "'" for c in "\u2018\u2019\u02bc\uff07"})
+
+def _crisis_stem(word):
+    """最後の語は活用形も拾う（self-harming / suicides / suicidal）。語尾の e は活用で落ちるので外す"""
+    if len(word) > 4 and word.endswith("e"):
+        word = word[:-1]
+    return re.escape(word) + r"\w*"
+
+def _crisis_pattern(keywords):
+    """キーワードを語頭の単語境界つきの1本の正規表現にまとめる（語の間は空白・ハイフンの揺れを許す）"""
+    alts = []
+    for kw in keywords:
+        words = re.split(r"[\s\-]+", kw)
+        alts.append(r"[\s\-]+".join([re.escape(w) for w in words[:-1]] + [_crisis_stem(words[-1])]))
+    return re.compile(r"\b(?:" + "|".join(sorted(alts, key=len, reverse=True)) + r")")
+
+CRISIS_RE = _crisis_pattern(CRISIS_KEYWORDS)
+
+def normalize_for_crisis(text):
+    return unicodedata.normalize("NFKC", text).casefold().translate(_CRISIS_TRANSLATE)
+
+def is_crisis(text):
+    return CRISIS_RE.search(normalize_for_crisis(str(text))) is not None
+
+def crisis_flags(texts):
+    """text 列全体をまとめて判定した bool 配列（データセット読み込み時の事前判定用）"""
+    normalized = texts.astype(str).str.normalize("NFKC").str.casefold().str.translate(_CRISIS_TRANSLATE)
+    return normalized.str.contains(CRISIS_RE).fillna(False).to_numpy(dtype=bool)
+
+def handle_crisis(user_input):
+    if is_crisis(user_input):
+        return CRISIS_REPLY
+    return None
+
+# === Chat Session の 1 ターン分のプロンプト ===
+def build_chat_prompt(profile, experiment_condition, turn_index, chat_history, user_input):
+    """Chat 画面のプロンプトを組み立てる。(prompt, used_traits) を返す。"""
+    tone_instruction, used = tone_for_turn(profile, experiment_condition, match=(turn_index >= 30))
+    return prompts.build_turn_prompt(profile, tone_instruction, chat_history, user_input), used
+
+
+# === 生成 API クライアント ===
+# GEN_API_URL でローカルのモック（mock_generate_server.py）などに向け先を変えられる
+API_URL = os.environ.get("GEN_API_URL", "https://royalmilktea103986368-dissintation.hf.space/generate")
+BATCH_API_URL = API_URL.rsplit("/", 1)[0] + "/generate_batch"   # {"prompts": [...]} -> {"responses": [...]}
+GEN_CONNECT_TIMEOUT_SEC = 5.0     # TCP/TLS 接続まで
+GEN_READ_TIMEOUT_SEC = 20.0       # 応答待ち（コールドスタート込み）
+GEN_MAX_ATTEMPTS = 4
+GEN_BACKOFF_BASE_SEC = 1.0        # 1, 2, 4, ... 秒を上限にジッター
+GEN_BACKOFF_MAX_SEC = 30.0
+GEN_RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+GEN_MAX_TOKENS = 180
+GEN_TEMPERATURE = 0.7
+GEN_TOP_P = 0.95
+
+@dataclass
+class GenerationResult:
+    text: Optional[str]        # 整形済みの応答（失敗時 None）
+    status: Optional[int]      # 最後の HTTP ステータス（接続エラーなら None）
+    attempts: int
+    latency_sec: float         # リトライ・待ち時間込みの合計
+    error: str = ""
+    cached: bool = False       # ResponseCache から返した
+
+    @property
+    def ok(self):
+        return self.text is not None
+
+
+def clean_reply(text):
+    return text.split("Assistant:")[-1].replace("\n\n", "\n").strip()
+
+def strip_prompt_echo(chunks, prompt):
+    """
+    stream() のチャンクから、バックエンドが応答の前に繰り返したプロンプト（末尾の "Assistant:" まで）を除いて yield する。
+    先頭がプロンプトと一致している間は表示を保留し、食い違った時点（繰り返しでない）でそのまま流し始める。
+    """
+    chunks = iter(chunks)
+    buf = ""
+    for chunk in chunks:
+        buf = (buf + chunk).lstrip()
+        if len(buf) < len(prompt) and prompt.startswith(buf):
+            continue   # まだプロンプトの繰り返しかもしれない
+        if buf.startswith(prompt):
+            buf = buf[len(prompt):]
+        elif "Assistant:" in buf:
+            buf = buf.split("Assistant:")[-1]   # 空白などが少し違う繰り返し（clean_reply と同じ切り方）
+        break
+    buf = buf.lstrip()
+    if buf:
+        yield buf
+    yield from chunks
+
+def _parse_retry_after(value):
+    """Retry-After（秒数 or HTTP日付）を秒に。解釈できなければ None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class GenerationClient:
+    """
+    /generate 用のクライアント（プロセス共通）。
+    - requests.Session + コネクションプールで keep-alive（毎ターンの TCP/TLS ハンドシェイクを省く）
+    - 接続と読み取りのタイムアウトを分ける
+    - 429/5xx・例外はジッター付き指数バックオフで再試行（Retry-After があればそれ以上待つ）
+    """
+    def __init__(self, url=API_URL, pool_size=32,
+                 connect_timeout=GEN_CONNECT_TIMEOUT_SEC, read_timeout=GEN_READ_TIMEOUT_SEC,
+                 max_attempts=GEN_MAX_ATTEMPTS, backoff_base=GEN_BACKOFF_BASE_SEC, backoff_max=GEN_BACKOFF_MAX_SEC):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # 計測用の累計（ベンチマーク・デバッグ表示向け）
+        self._stats_lock = threading.Lock()
+        self.requests_sent = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _record(self, requests=1, retries=0, failures=0):
+        with self._stats_lock:
+            self.requests_sent += requests
+            self.retries += retries
+            self.failures += failures
+
+    def stats(self):
+        with self._stats_lock:
+            return {"requests": self.requests_sent, "retries": self.retries, "failures": self.failures}
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def generate(self, prompt, limiter=None, max_tokens=GEN_MAX_TOKENS, temperature=GEN_TEMPERATURE, top_p=GEN_TOP_P,
+                 seed=None, cache=None, conversation_id=None):
+        """conversation_id: 同じ会話のターンで同じ値（prefix キャッシュを持つバックエンドが KV を使い回す目印）"""
+        payload = {"prompt": prompt, "max_tokens": max_tokens, "temperature": temperature, "top_p": top_p}
+        if seed is not None:
+            payload["seed"] = seed
+        if conversation_id:
+            payload["conversation_id"] = conversation_id
+        start = time.monotonic()
+        if cache is not None:
+            key = ResponseCache.make_key(prompt, max_tokens, temperature, top_p, seed)
+            text = cache.get(key)
+            if text is not None:
+                return GenerationResult(text, None, 0, time.monotonic() - start, cached=True)
+        status, error = None, ""
+        for attempt in range(1, self.max_attempts + 1):
+            if limiter is not None:
+                limiter.acquire()
+            retry_after = None
+            self._record(retries=int(attempt > 1))
+            try:
+                r = self.session.post(self.url, json=payload, timeout=self.timeout)
+                status = r.status_code
+                if status == 200:
+                    text = (r.json().get("response") or "").strip()
+                    if text:
+                        reply = clean_reply(text)
+                        if cache is not None:
+                            cache.put(key, reply)
+                        return GenerationResult(reply, status, attempt, time.monotonic() - start)
+                    error = "empty response"
+                elif status in GEN_RETRY_STATUSES:
+                    retry_after = _parse_retry_after(r.headers.get("Retry-After"))
+                    error = f"HTTP {status}"
+                else:
+                    error = f"HTTP {status}"
+                    break  # 再試行しても変わらない（4xx など）
+            except (requests.RequestException, ValueError) as e:
+                error = f"{type(e).__name__}: {e}"
+            if attempt < self.max_attempts:
+                time.sleep(self._backoff(attempt, retry_after))
+        self._record(requests=0, failures=1)
+        return GenerationResult(None, status, attempt, time.monotonic() - start, error)
+
+    def stream(self, prompt, max_tokens=GEN_MAX_TOKENS, temperature=GEN_TEMPERATURE, top_p=GEN_TOP_P,
+               conversation_id=None):
+        """
+        応答をトークンが届いた順に yield する（st.write_stream 用）。
+        SSE（data: 行）/ chunked テキスト / 通常の JSON 応答のどれが返ってきても扱える。
+        最初のトークンが来る前に失敗したら generate()（リトライ付き）に切り替える。
+        途中で切れた場合はそこまでの文で終える。
+        """
+        payload = {"prompt": prompt, "max_tokens": max_tokens, "temperature": temperature, "top_p": top_p, "stream": True}
+        if conversation_id:
+            payload["conversation_id"] = conversation_id
+        started = False
+        self._record()
+        try:
+            with self.session.post(self.url, json=payload, timeout=self.timeout, stream=True,
+                                   headers={"Accept": "text/event-stream, application/json"}) as r:
+                ctype = r.headers.get("Content-Type", "")
+                r.encoding = r.encoding or "utf-8"
+                # 200 以外（429 / 5xx など）はどの分岐にも入らず started=False のまま → 下の generate() が
+                # ステータスに応じたリトライ・バックオフ込みで取り直す
+                ok = r.status_code == 200
+                if ok and "text/event-stream" in ctype:
+                    for line in r.iter_lines(chunk_size=None, decode_unicode=True):
+                        if not line or not line.startswith("data:"):
+                            continue
+                        data = line[5:]
+                        data = data[1:] if data.startswith(" ") else data
+                        if data.strip() == "[DONE]":
+                            break
+                        token = _sse_token(data)
+                        if token:
+                            started = True
+                            yield token
+                elif ok and "application/json" in ctype:
+                    text = (r.json().get("response") or "").strip()
+                    if text:
+                        started = True
+                        yield clean_reply(text)
+                elif ok:
+                    for chunk in r.iter_content(chunk_size=None, decode_unicode=True):
+                        if chunk:
+                            started = True
+                            yield chunk
+        except (requests.RequestException, ValueError):
+            pass
+        if not started:
+            self._record(requests=0, retries=1)   # ストリームの失敗 → generate での取り直しは再試行として数える
+            result = self.generate(prompt, max_tokens=max_tokens, temperature=temperature, top_p=top_p,
+                                   conversation_id=conversation_id)
+            if result.text:
+                yield result.text
+
+
+def _sse_token(data):
+    """SSE の data 部分からテキストを取り出す（{"token": {"text": ...}} / {"token": ...} / {"response": ...} / 生テキスト）"""
+    try:
+        obj = json.loads(data)
+    except ValueError:
+        return data
+    if isinstance(obj, str):
+        return obj
+    if not isinstance(obj, dict):
+        return ""
+    token = obj.get("token", obj.get("text", obj.get("response", "")))
+    if isinstance(token, dict):
+        if token.get("special"):
+            return ""
+        token = token.get("text", "")
+    return token or ""
+
+
+@st.cache_resource(show_spinner=False)
+def get_generation_client():
+    return GenerationClient()
+
+CHAT_STREAMING = True   # Chat Session で応答をストリーミング表示する
+
+def call_api(prompt, limiter=None, cache=None, conversation_id=None):
+    """応答テキストだけが欲しい呼び出し側向け（失敗時 None）"""
+    return get_generation_client().generate(prompt, limiter=limiter, cache=cache, conversation_id=conversation_id).text
+
+
+# === 応答キャッシュ（シミュレーションの再実行用、オプトイン） ===
+RESPONSE_CACHE_PATH = ".cache/gen_responses.sqlite"
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024   # 応答テキストの合計サイズ上限（超えたら LRU で削除）
+
+class ResponseCache:
+    """
+    (prompt, max_tokens, temperature, top_p, seed) のハッシュ -> 応答テキスト を SQLite に保存する。
+    参照のたびに last_used を更新し、合計サイズが上限を超えたら最後に使われたのが古いものから消す。
+    """
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+        self._bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(prompt, max_tokens, temperature, top_p, seed=None):
+        raw = json.dumps([prompt, max_tokens, temperature, top_p, seed], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, response):
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._bytes += size - (old[0] if old else 0)
+            excess = self._bytes - self.max_bytes
+            if excess > 0:
+                # 古いものから、超過分を埋めるのに要る行だけを消す（今書いた行は残す）
+                evicted, freed = [], 0
+                for k, n in self._conn.execute(
+                    "SELECT key, size FROM responses WHERE key != ? ORDER BY last_used", (key,)
+                ):
+                    evicted.append((k,))
+                    freed += n
+                    if freed >= excess:
+                        break
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+                self._bytes -= freed
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"entries": entries, "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    return ResponseCache()
+
+def prewarm_response_cache(cache, log_rows, flip_after=30):
+    """
+    LOGS_* の行（get_all_records の結果をまとめたもの）から擬似ユーザーの会話を再構成し、
+    run_simulation_for_user_slow と同じプロンプトをキーに AI 応答を登録する。
+    途中のターンが欠けている会話はそこで打ち切る。登録した件数を返す。
+    """
+    sessions = {}
+    for r in log_rows:
+        if str(r.get("GroupID", "0")) in ("", "0"):
+            continue  # 参加者の会話はシミュレーションでは再生しない
+        sessions.setdefault(r.get("SessionID"), {}).setdefault(int(r.get("Turn") or 0), {})[r.get("Role")] = r
+
+    added = 0
+    for turns in sessions.values():
+        first = turns[min(turns)].get("User") or turns[min(turns)].get("AI")
+        username = first.get("Username")
+        exp_cond = first.get("ExperimentCondition")
+        profile_row = get_profile(username)
+        if not profile_row:
+            continue
+        profile_dict = build_profile_from_center(profile_row)
+        rng = random.Random(username)
+        chat_history = []
+        for turn_index in range(1, max(turns) + 1):
+            pair = turns.get(turn_index, {})
+            if "User" not in pair or "AI" not in pair:
+                break
+            ux, ai_reply = str(pair["User"].get("Message", "")), str(pair["AI"].get("Message", ""))
+            prompt, _ = build_sim_turn_prompt(profile_dict, exp_cond, turn_index >= flip_after, chat_history, ux, rng=rng)
+            if not handle_crisis(ux) and ai_reply and ai_reply != "[Simulation] No response.":
+                cache.put(ResponseCache.make_key(prompt, GEN_MAX_TOKENS, GEN_TEMPERATURE, GEN_TOP_P), ai_reply)
+                added += 1
+            chat_history.extend([{"role":"User","content":ux},{"role":"AI","content":ai_reply}])
+    return added
+
+# === マイクロバッチ（同時に走っている擬似ユーザーのプロンプトをまとめて送る） ===
+GEN_BATCH_MAX_SIZE = 8
+GEN_BATCH_MAX_WAIT_SEC = 0.05
+GEN_BATCH_MAX_INFLIGHT = 4      # 同時に送るバッチ数
+
+class GenerationBatcher:
+    """
+    各会話スレッドの generate() を受け付け、max_batch_size 件たまるか max_wait_sec 経ったら
+    /generate_batch に1リクエストで送り、応答をそれぞれの会話に返す。
+    バッチ API が無い（404/405/501）・失敗・件数不一致のときは1件ずつの GenerationClient.generate に戻す。
+    """
+    def __init__(self, client, url=BATCH_API_URL, max_batch_size=GEN_BATCH_MAX_SIZE,
+                 max_wait_sec=GEN_BATCH_MAX_WAIT_SEC, limiter=None):
+        self.client = client
+        self.url = url
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_sec = max_wait_sec
+        self.limiter = limiter
+        self.batch_supported = True
+        self.batches_sent = 0
+        self.fallbacks = 0
+        self._queue = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=GEN_BATCH_MAX_INFLIGHT + self.max_batch_size,
+                                        thread_name_prefix="gen-batch")
+        self._thread = threading.Thread(target=self._run, name="gen-batcher", daemon=True)
+        self._thread.start()
+
+    def generate(self, prompt, cache=None, conversation_id=None):
+        """会話スレッドから呼ぶ（結果が返るまでブロック）"""
+        key = None
+        if cache is not None:
+            key = ResponseCache.make_key(prompt, GEN_MAX_TOKENS, GEN_TEMPERATURE, GEN_TOP_P)
+            text = cache.get(key)
+            if text is not None:
+                return GenerationResult(text, None, 0, 0.0, cached=True)
+        future = Future()
+        self._queue.put(((prompt, conversation_id), future, time.monotonic()))
+        result = future.result()
+        if cache is not None and result.ok:
+            cache.put(key, result.text)
+        return result
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._pool.shutdown(wait=True)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait_sec
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._pool.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        if self.batch_supported and len(batch) > 1:
+            try:
+                texts, status = self._post_batch([item for item, _, _ in batch])   # item = (prompt, conversation_id)
+            except Exception:
+                texts, status = None, None
+            if texts is not None:
+                self.batches_sent += 1
+                retry = []
+                for (item, future, queued_at), text in zip(batch, texts):
+                    if text:
+                        future.set_result(GenerationResult(text, status, 1, time.monotonic() - queued_at))
+                    else:
+                        retry.append((item, future, queued_at))
+                batch = retry
+        # 1件ずつ（リトライ付き）に戻す。会話ごとに並列で投げる
+        for item, future, queued_at in batch:
+            self.fallbacks += 1
+            self._pool.submit(self._single, item, future)
+
+    def _single(self, item, future):
+        prompt, conversation_id = item
+        try:
+            future.set_result(self.client.generate(prompt, limiter=self.limiter, conversation_id=conversation_id))
+        except Exception as e:
+            future.set_result(GenerationResult(None, None, 0, 0.0, f"{type(e).__name__}: {e}"))
+
+    def _post_batch(self, items):
+        if self.limiter is not None:
+            self.limiter.acquire()   # バッチ1回 = API 呼び出し1回
+        prompts = [p for p, _ in items]
+        payload = {"prompts": prompts, "max_tokens": GEN_MAX_TOKENS, "temperature": GEN_TEMPERATURE, "top_p": GEN_TOP_P}
+        if any(c for _, c in items):
+            payload["conversation_ids"] = [c or "" for _, c in items]
+        self.client._record()
+        r = self.client.session.post(self.url, json=payload, timeout=self.client.timeout)
+        if r.status_code in (404, 405, 501):
+            self.batch_supported = False   # バッチ非対応のバックエンド → 以降は1件ずつ
+            return None, r.status_code
+        if r.status_code != 200:
+            return None, r.status_code
+        responses = r.json().get("responses")
+        if not isinstance(responses, list) or len(responses) != len(prompts):
+            return None, r.status_code
+        return [clean_reply(str(t)) if t else None for t in responses], r.status_code
+
+
+#「続きからシミュレーション再開」できるように進捗を永続化
+SIM_META_HEADER = ["Key","Value","UpdatedAt"]
+
+def get_meta_ws():
+    return get_worksheet("SIM_META", header=SIM_META_HEADER, rows="100")
+
+
+class SimStateStore:
+    """
+    SIM_META を「1キー1行」のキーバリューストアとして扱う（プロセス共通）。
+    - 初回に get_all_values 1回で全キーを読み、以降はローカルのキャッシュから返す
+    - 既存キーはその行を上書き（update）、新しいキーだけ append。set_many は全キーをまとめて最大2回の API 呼び出し
+    - 以前の追記方式で同じキーが複数行ある場合は最後の行を正とし、以降はその行を更新する
+    別プロセスからも書き込む場合は refresh() で読み直す。
+    """
+    def __init__(self, ws):
+        self.ws = ws
+        self._lock = threading.Lock()
+        self._incr_lock = threading.Lock()
+        self._values = {}   # key -> value(str)
+        self._rows = {}     # key -> 行番号
+        self._loaded = False
+
+    def refresh(self):
+        values = self.ws.get_all_values()
+        with self._lock:
+            self._values, self._rows = {}, {}
+            for row_no, r in enumerate(values[1:], start=2):
+                if r and r[0]:
+                    self._values[r[0]] = r[1] if len(r) > 1 else ""
+                    self._rows[r[0]] = row_no
+            self._loaded = True
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.refresh()
+
+    def get(self, key, default=None):
+        self._ensure_loaded()
+        with self._lock:
+            return self._values.get(key, default)
+
+    def get_int(self, key, default=None):
+        value = self.get(key)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+    def get_many(self, keys):
+        self._ensure_loaded()
+        with self._lock:
+            return {k: self._values.get(k) for k in keys}
+
+    def set(self, key, value):
+        return self.set_many({key: value})
+
+    def set_many(self, items):
+        """{key: value} を書き込む。既存キーは batch_update 1回、新規キーは append_rows 1回"""
+        self._ensure_loaded()
+        ts = datetime.utcnow().isoformat()
+        with self._lock:
+            updates = [
+                {"range": f"A{self._rows[k]}:C{self._rows[k]}", "values": [[k, str(v), ts]]}
+                for k, v in items.items() if k in self._rows
+            ]
+            new_rows = [[k, str(v), ts] for k, v in items.items() if k not in self._rows]
+        for i in range(5):
+            try:
+                if updates:
+                    self.ws.batch_update(updates)
+                    updates = []
+                resp = self.ws.append_rows(new_rows) if new_rows else None
+                break
+            except gspread.exceptions.APIError:
+                time.sleep(2.0 * (i + 1))
+        else:
+            st.error("Failed to write simulation state after multiple retries.")
+            return False
+        with self._lock:
+            for k, v in items.items():
+                self._values[k] = str(v)
+            if new_rows:
+                try:
+                    updated = resp["updates"]["updatedRange"]   # 例: "SIM_META!A5:C6"
+                    first = int(re.search(r"[A-Z]+(\d+)", updated.split("!")[-1]).group(1))
+                    for offset, r in enumerate(new_rows):
+                        self._rows[r[0]] = first + offset
+                except Exception:
+                    self._loaded = False   # 行番号が分からなければ次回読み直す
+        return True
+
+    def incr(self, key, delta=1):
+        """キャッシュ上の値に delta を足して書き込み、新しい値を返す（読み込みの API 呼び出しなし）"""
+        with self._incr_lock:   # 同じプロセス内で同じ値を2回払い出さない
+            value = (self.get_int(key) or 0) + delta
+            self.set(key, value)
+        return value
+
+
+@st.cache_resource(show_spinner=False)
+def get_sim_state_store():
+    return SimStateStore(get_meta_ws())
+
+def read_sim_state(key="DISJOINT_PTR"):
+    return get_sim_state_store().get_int(key)
+
+def write_sim_state(key, value):
+    get_sim_state_store().set(key, value)
+
+# --- ヘッドレス実行（sim_runner.py）の進捗 ---
+# ランナーの親プロセスだけが DISJOINT_PTR と RUNNER_STATUS（JSON）を書き、管理画面はそれを読んで表示する
+RUNNER_STATUS_KEY = "RUNNER_STATUS"
+RUNNER_HEARTBEAT_SEC = 15    # 実行中はこの間隔で RUNNER_STATUS を書き直す
+RUNNER_STALE_SEC = 120       # これより古い "running" はランナーが落ちたものとみなす
+
+def read_runner_status(refresh=False):
+    """RUNNER_STATUS を dict で返す（無ければ None）。refresh=True なら SIM_META を読み直す（別プロセスの書き込みを見る）"""
+    store = get_sim_state_store()
+    if refresh:
+        store.refresh()
+    try:
+        status = json.loads(store.get(RUNNER_STATUS_KEY) or "null")
+    except ValueError:
+        return None
+    if not isinstance(status, dict):
+        return None
+    status["age_sec"] = round(time.time() - float(status.get("updated", 0)), 1)
+    status["alive"] = status.get("state") == "running" and status["age_sec"] < RUNNER_STALE_SEC
+    return status
+
+
+# ==== Checkpoint helpers (resume on rerun) ====
+# 擬似ユーザーごとに SIM_META の1行: CKP:{username} -> {"last_turn", "mode", "session_id", "history"}
+CKP_KEY_PREFIX = "CKP:"
+CKP_HISTORY_MESSAGES = 4   # build_sim_turn_prompt が文脈に使う直近の発話数
+
+def read_checkpoint(username):
+    raw = get_sim_state_store().get(CKP_KEY_PREFIX + username)
+    if not raw:
+        return None
+    try:
+        ckp = json.loads(raw)
+        last_turn = int(ckp.get("last_turn", -1))
+    except (TypeError, ValueError, AttributeError):
+        return None
+    if last_turn < 0:
+        return None
+    return {
+        "username": username,
+        "last_turn": last_turn,
+        "mode": ckp.get("mode") or "",          # ExperimentCondition
+        "session_id": ckp.get("session_id") or "",
+        "history": ckp.get("history") or [],    # 直近の発話（再開時の文脈）
+    }
+
+def _checkpoint_value(last_turn, mode, session_id, history):
+    return json.dumps({"last_turn": int(last_turn), "mode": mode, "session_id": session_id,
+                       "history": list(history)[-CKP_HISTORY_MESSAGES:]}, ensure_ascii=False)
+
+def write_checkpoint(username, last_turn, mode, session_id, history=()):
+    get_sim_state_store().set(CKP_KEY_PREFIX + username, _checkpoint_value(last_turn, mode, session_id, history))
+
+def clear_checkpoint(username):
+    get_sim_state_store().set(CKP_KEY_PREFIX + username, "")
+
+def resume_point(username, session_id):
+    """
+    session_id の再開位置 = SIM_META のチェックポイント + ローカル WAL にあってまだ LOGS_* に届いていないターン。
+    WAL に書いたターンはいずれ複製されるので、やり直さない（やり直すとログが重複する）。
+    チェックポイントや WAL の行が同じ名前の別セッションのものなら使わない（そのセッションの記録が無ければ None）。
+    """
+    ckp = read_checkpoint(username)
+    if ckp is None or ckp["session_id"] != session_id:
+        ckp = {"username": username, "last_turn": 0, "mode": "", "session_id": session_id, "history": []}
+    rows = get_log_pipeline().turn_log.user_rows(username, session_id, after_turn=ckp["last_turn"])
+    turns = {}
+    for r in rows:
+        turns.setdefault(int(r[7]), {"mode": r[5]})[r[2]] = r[3]   # Role -> Message
+    last_turn, history, mode = ckp["last_turn"], list(ckp["history"]), ckp["mode"]
+    while "User" in turns.get(last_turn + 1, {}) and "AI" in turns[last_turn + 1]:
+        t = turns[last_turn + 1]
+        history.extend([{"role": "User", "content": t["User"]}, {"role": "AI", "content": t["AI"]}])
+        mode = mode or t["mode"]
+        last_turn += 1
+    if last_turn <= 0:
+        return None
+    return {"username": username, "last_turn": last_turn, "mode": mode, "session_id": session_id,
+            "history": history[-CKP_HISTORY_MESSAGES:]}
+
+def other_sessions(username, session_id):
+    """同じ username で session_id 以外に進んでいるセッション（チェックポイント・ローカル WAL）。名前の衝突検出用"""
+    ckp = read_checkpoint(username)
+    sessions = get_log_pipeline().turn_log.user_sessions(username) | ({ckp["session_id"]} if ckp else set())
+    return sorted(sessions - {session_id, ""})
+
+
+class TurnCheckpointer:
+    """
+    シミュレーションの進捗を「ログ行が実際に書き込まれたターン」まで SIM_META に記録する。
+    - run_simulation_for_user_slow(resume=True) は毎ターン note() を呼ぶ（メモリ上だけ、API 呼び出しなし）
+    - このプロセスが書いたログ行の複製（LOGS_* への append_rows。リースを持つ別プロセスが送っても同じ）を
+      LogReplicator が確認するたびに on_rows_flushed() が呼ばれ、
+      先頭から連続して書けたターンまで進んだユーザーの分を set_many 1回でまとめて書く
+    ログの flush とチェックポイントの書き込みの間で落ちた場合だけ、再開時にそのバッチ分のターンが重複する。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}   # (username, session_id) -> {"committed": int, "flushed": set, "snaps": {turn: (mode, history)}}
+
+    def note(self, username, session_id, turn, mode, history, committed=0):
+        with self._lock:
+            u = self._users.setdefault((username, session_id), {"committed": committed, "flushed": set(), "snaps": {}})
+            u["snaps"][turn] = (mode, list(history)[-CKP_HISTORY_MESSAGES:])
+
+    def forget(self, username, session_id):
+        with self._lock:
+            self._users.pop((username, session_id), None)
+
+    def on_rows_flushed(self, rows):
+        items = {}
+        with self._lock:
+            for r in rows:
+                u = self._users.get((r[1], r[0]))   # LOG_HEADER: SessionID, Username, ..., Turn(7)
+                if u is not None:
+                    u["flushed"].add(int(r[7]))
+            for (username, session_id), u in self._users.items():
+                turn = u["committed"]
+                while turn + 1 in u["flushed"]:
+                    turn += 1
+                if turn == u["committed"] or turn not in u["snaps"]:
+                    continue
+                mode, history = u["snaps"][turn]
+                items[CKP_KEY_PREFIX + username] = _checkpoint_value(turn, mode, session_id, history)
+                u["flushed"] = {t for t in u["flushed"] if t > turn}
+                u["snaps"] = {t: v for t, v in u["snaps"].items() if t > turn}
+                u["committed"] = turn
+        if items:
+            get_sim_state_store().set_many(items)
+
+
+@st.cache_resource(show_spinner=False)
+def get_turn_checkpointer():
+    return TurnCheckpointer()
+
+
+def next_slow_seq():
+    return get_sim_state_store().incr("SLOW_SEQ")
@@ -0,0 +1,333 @@
+# gspread 互換のメモリ上のスプレッドシート（オフライン実行・負荷試験用）
+# アプリが使う範囲だけを実装する:
+#   Spreadsheet: worksheet / add_worksheet / worksheets
+#   Worksheet:   append_row / append_rows / get_all_values / get_values / get_all_records /
+#                findall / row_values / update / batch_update
+# グリッドの大きさ（row_count / col_count）も持ち、append で伸び、外を指す範囲の読み込みは 400 になる。
+# すべての呼び出しを Sheets API の1リクエストとして数え、分あたりの上限（既定はユーザーあたり
+# read 60 / write 60）に対する使用量を出す。上限超過時や任意の割合で APIError(429) を投げられる。
+# path を渡すと JSON ファイルに保存・復元する（save() と終了時）。
+import atexit
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+
+import gspread
+import requests
+from gspread.cell import Cell
+from gspread.utils import a1_range_to_grid_range, numericise_all, rowcol_to_a1
+
+SHEETS_READS_PER_MIN = 60     # Sheets API: Read requests per minute per user per project
+SHEETS_WRITES_PER_MIN = 60    # Sheets API: Write requests per minute per user per project
+
+READ_METHODS = {"worksheet", "worksheets", "get_all_values", "get_values", "get_all_records", "findall", "row_values"}
+
+
+def make_api_error(code=429, message="Quota exceeded (memory backend)", status="RESOURCE_EXHAUSTED"):
+    """本物と同じく requests.Response を持つ APIError を作る（呼び出し側の except がそのまま効く）"""
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({"error": {"code": code, "message": message, "status": status}}).encode("utf-8")
+    return gspread.exceptions.APIError(response)
+
+
+class QuotaMeter:
+    """直近60秒の read / write リクエスト数（と累計）。enforce=True なら上限超過で 429"""
+    def __init__(self, reads_per_min=SHEETS_READS_PER_MIN, writes_per_min=SHEETS_WRITES_PER_MIN,
+                 enforce=False, error_rate=0.0, seed=None):
+        self.limits = {"read": reads_per_min, "write": writes_per_min}
+        self.enforce = enforce
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = {"read": deque(), "write": deque()}
+        self._peak = {"read": 0, "write": 0}
+        self.totals = {"read": 0, "write": 0, "throttled": 0, "injected": 0}
+        self.by_method = {}
+        self._fail_next = []
+
+    def fail_next(self, n=1, code=429):
+        """次の n 回の呼び出しを APIError(code) にする"""
+        with self._lock:
+            self._fail_next.extend([code] * n)
+
+    def charge(self, method):
+        kind = "read" if method in READ_METHODS else "write"
+        with self._lock:
+            now = time.monotonic()
+            window = self._window[kind]
+            while window and now - window[0] >= 60.0:
+                window.popleft()
+            if self._fail_next:
+                self.totals["injected"] += 1
+                raise make_api_error(self._fail_next.pop(0))
+            if self.error_rate and self._rng.random() < self.error_rate:
+                self.totals["injected"] += 1
+                raise make_api_error()
+            if self.enforce and len(window) >= self.limits[kind]:
+                self.totals["throttled"] += 1
+                raise make_api_error(message=f"Quota exceeded for quota metric '{kind.title()} requests' (memory backend)")
+            window.append(now)
+            self._peak[kind] = max(self._peak[kind], len(window))
+            self.totals[kind] += 1
+            self.by_method[method] = self.by_method.get(method, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            last_min = {k: sum(1 for t in w if now - t < 60.0) for k, w in self._window.items()}
+            return {
+                "reads_last_min": last_min["read"], "writes_last_min": last_min["write"],
+                "read_limit": self.limits["read"], "write_limit": self.limits["write"],
+                "peak_reads_per_min": self._peak["read"], "peak_writes_per_min": self._peak["write"],
+                **self.totals, "by_method": dict(self.by_method),
+            }
+
+
+def _cell_str(value):
+    """USER_ENTERED で書いたときに get_all_values で返ってくる文字列"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return str(value)
+
+
+class MemoryWorksheet:
+    def __init__(self, spreadsheet, title, sheet_id, rows=1000, cols=26, values=None):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.row_count = int(rows)
+        self.col_count = int(cols)
+        self._rows = values or []
+
+    def __repr__(self):
+        return f"<MemoryWorksheet {self.title!r} id:{self.id}>"
+
+    def _charge(self, method):
+        self.spreadsheet._charge(method)
+
+    def _range(self, start_row, end_row, ncols):
+        return f"'{self.title}'!{rowcol_to_a1(start_row, 1)}:{rowcol_to_a1(end_row, max(1, ncols))}"
+
+    # --- 書き込み ---
+    def append_row(self, values, value_input_option="RAW", **kwargs):
+        return self.append_rows([values], value_input_option=value_input_option, **kwargs)
+
+    def append_rows(self, values, value_input_option="RAW", **kwargs):
+        self._charge("append_rows")
+        rows = [[_cell_str(v) for v in row] for row in values]
+        with self.spreadsheet._lock:
+            start = len(self._rows) + 1
+            self._rows.extend(rows)
+            end = len(self._rows)
+            self.row_count = max(self.row_count, end)
+            self.col_count = max([self.col_count] + [len(r) for r in rows])
+            self.spreadsheet._dirty = True
+        ncols = max([len(r) for r in rows] or [1])
+        return {
+            "spreadsheetId": self.spreadsheet.id,
+            "updates": {
+                "spreadsheetId": self.spreadsheet.id,
+                "updatedRange": self._range(start, end, ncols),
+                "updatedRows": len(rows),
+                "updatedColumns": ncols,
+                "updatedCells": sum(len(r) for r in rows),
+            },
+        }
+
+    def update(self, values=None, range_name=None, **kwargs):
+        # gspread 5 の update(range_name, values) の順でも受け付ける
+        if isinstance(values, str) and not isinstance(range_name, str):
+            values, range_name = range_name, values
+        self._charge("update")
+        return self._write_range(values, range_name)
+
+    def batch_update(self, data, **kwargs):
+        """[{"range": "A2:C2", "values": [[...]]}, ...] を1リクエストで書く"""
+        self._charge("batch_update")
+        responses = [self._write_range(d["values"], d["range"]) for d in data]
+        return {"spreadsheetId": self.spreadsheet.id, "totalUpdatedRows": sum(r["updatedRows"] for r in responses),
+                "responses": responses}
+
+    def _write_range(self, values, range_name):
+        if values and not isinstance(values[0], (list, tuple)):
+            values = [values]
+        grid = a1_range_to_grid_range(range_name or "A1")
+        r0, c0 = grid.get("startRowIndex", 0), grid.get("startColumnIndex", 0)
+        with self.spreadsheet._lock:
+            for i, row in enumerate(values or []):
+                while len(self._rows) <= r0 + i:
+                    self._rows.append([])
+                target = self._rows[r0 + i]
+                for j, v in enumerate(row):
+                    while len(target) <= c0 + j:
+                        target.append("")
+                    target[c0 + j] = _cell_str(v)
+            self.spreadsheet._dirty = True
+        ncols = max([len(r) for r in values or []] or [1])
+        return {
+            "spreadsheetId": self.spreadsheet.id,
+            "updatedRange": self._range(r0 + 1, r0 + len(values or []), c0 + ncols),
+            "updatedRows": len(values or []),
+        }
+
+    # --- 読み込み ---
+    def _snapshot(self):
+        with self.spreadsheet._lock:
+            return [list(r) for r in self._rows]
+
+    def get_all_values(self, **kwargs):
+        self._charge("get_all_values")
+        rows = self._snapshot()
+        width = max([len(r) for r in rows] or [0])
+        return [r + [""] * (width - len(r)) for r in rows]
+
+    def get_values(self, range_name=None, **kwargs):
+        self._charge("get_values")
+        rows = self._snapshot()
+        if range_name is None:
+            width = max([len(r) for r in rows] or [0])
+            return [r + [""] * (width - len(r)) for r in rows]
+        grid = a1_range_to_grid_range(range_name.split("!")[-1])
+        r0, r1 = grid.get("startRowIndex", 0), grid.get("endRowIndex", len(rows))
+        c0, c1 = grid.get("startColumnIndex", 0), grid.get("endColumnIndex")
+        if max(r0 + 1, grid.get("endRowIndex", 0)) > self.row_count or (c1 or 0) > self.col_count:
+            # 本物と同じく、グリッド（row_count x col_count）の外を指す範囲は 400
+            raise make_api_error(400, f"Range ('{self.title}'!{range_name.split('!')[-1]}) exceeds grid limits. "
+                                      f"Max rows: {self.row_count}, max columns: {self.col_count}", "INVALID_ARGUMENT")
+        out = [r[c0:c1] for r in rows[r0:r1]]
+        while out and not any(out[-1]):
+            out.pop()   # 本物と同じく末尾の空行は返らない
+        return out
+
+    def get_all_records(self, head=1, default_blank="", numericise_ignore=None, **kwargs):
+        self._charge("get_all_records")
+        rows = self._snapshot()
+        if len(rows) < head:
+            return []
+        keys = rows[head - 1]
+        records = []
+        for r in rows[head:]:
+            r = r + [default_blank] * (len(keys) - len(r))
+            records.append(dict(zip(keys, numericise_all(r[:len(keys)], default_blank=default_blank,
+                                                        ignore=numericise_ignore or []))))
+        return records
+
+    def findall(self, query, in_row=None, in_column=None, case_sensitive=True):
+        self._charge("findall")
+        cells = []
+        for i, row in enumerate(self._snapshot(), start=1):
+            if in_row is not None and i != in_row:
+                continue
+            for j, v in enumerate(row, start=1):
+                if in_column is not None and j != in_column:
+                    continue
+                if isinstance(query, re.Pattern):
+                    hit = query.search(v) is not None
+                else:
+                    hit = (v == str(query)) if case_sensitive else (v.lower() == str(query).lower())
+                if hit:
+                    cells.append(Cell(i, j, v))
+        return cells
+
+    def row_values(self, row, **kwargs):
+        self._charge("row_values")
+        with self.spreadsheet._lock:
+            values = list(self._rows[row - 1]) if 0 < row <= len(self._rows) else []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+
+class MemorySpreadsheet:
+    """
+    gspread.Spreadsheet の代わり。スレッドセーフ（ワークシート全体で1つのロック）。
+    latency_sec を渡すと各呼び出しでその分だけ待つ（本物の往復時間の目安）。
+    """
+    def __init__(self, path=None, quota=None, latency_sec=0.0, title="Memory Spreadsheet"):
+        self.id = "memory"
+        self.title = title
+        self.path = path
+        self.quota = quota or QuotaMeter()
+        self.latency_sec = latency_sec
+        self._lock = threading.RLock()
+        self._sheets = {}
+        self._next_id = 1
+        self._dirty = False
+        if path and os.path.exists(path):
+            self._load(path)
+
+    def _charge(self, method):
+        self.quota.charge(method)
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+
+    def worksheet(self, title):
+        self._charge("worksheet")
+        with self._lock:
+            if title not in self._sheets:
+                raise gspread.exceptions.WorksheetNotFound(title)
+            return self._sheets[title]
+
+    def worksheets(self, **kwargs):
+        self._charge("worksheets")
+        with self._lock:
+            return list(self._sheets.values())
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        self._charge("add_worksheet")
+        with self._lock:
+            if title in self._sheets:
+                raise make_api_error(400, f'A sheet with the name "{title}" already exists.', "INVALID_ARGUMENT")
+            ws = MemoryWorksheet(self, title, self._next_id, rows, cols)
+            self._sheets[title] = ws
+            self._next_id += 1
+            self._dirty = True
+            return ws
+
+    # --- ファイル保存 ---
+    def _load(self, path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        for s in data.get("sheets", []):
+            ws = MemoryWorksheet(self, s["title"], s["id"], s.get("rows", 1000), s.get("cols", 26), s["values"])
+            self._sheets[ws.title] = ws
+            self._next_id = max(self._next_id, ws.id + 1)
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            data = {"sheets": [
+                {"title": ws.title, "id": ws.id, "rows": ws.row_count, "cols": ws.col_count, "values": ws._rows}
+                for ws in self._sheets.values()
+            ]}
+            tmp = f"{self.path}.tmp"
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._dirty = False
+
+
+def open_memory_spreadsheet(path=None, seed_sheets=None, **kwargs):
+    """
+    MemorySpreadsheet を作る。seed_sheets={title: header} は無ければヘッダ付きで作る（呼び出し回数には数えない）。
+    path があれば終了時に保存する。
+    """
+    sh = MemorySpreadsheet(path=path, **kwargs)
+    for title, header in (seed_sheets or {}).items():
+        if title not in sh._sheets:
+            ws = MemoryWorksheet(sh, title, sh._next_id, 1000, len(header), [[_cell_str(v) for v in header]])
+            sh._sheets[title] = ws
+            sh._next_id += 1
+            sh._dirty = True
+    if path:
+        atexit.register(sh.save)
+    return sh
@@ -0,0 +1,263 @@
+# /generate のローカル代用サーバー（負荷試験・オフライン開発用）
+# HF Space と同じ形の API を返す:
+#   POST /generate        {"prompt": ...}            -> {"response": "..."}
+#                         "stream": true + Accept: text/event-stream なら SSE（data: {"token": ...} / data: [DONE]）
+#   POST /generate_batch  {"prompts": [...]}         -> {"responses": [...]}
+#   GET  /stats           受けたリクエスト数などの累計
+#                         conversation_id ごとに前回のプロンプトと共通の先頭部分（prefix キャッシュで再利用できる分）も数える
+# 使い方:
+#   python mock_generate_server.py --port 8765 --latency-ms 800 --jitter 0.5 --error-rate 0.05 --cold-start-sec 10
+#   GEN_API_URL=http://127.0.0.1:8765/generate streamlit run "統合版のwebページ test.py"
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY_OPENERS = [
+    "It makes sense that {topic} has been on your mind lately.",
+    "Thanks for sharing how {topic} is affecting you.",
+    "You mentioned {topic}, and that sounds like a lot to carry.",
+]
+REPLY_TIPS = [
+    "One small thing that may help is a five-minute walk, because movement can loosen a tense mood.",
+    "You could try writing down one worry and one next step, since naming it often makes it feel smaller.",
+    "A short breathing pause before bed might help, because it gives your body a cue to slow down.",
+]
+REPLY_QUESTIONS = [
+    "What part of it feels hardest right now?",
+    "When did you first notice this?",
+    "Who do you usually talk to when this happens?",
+]
+
+
+class MockConfig:
+    """応答時間・エラー・コールドスタートの設定"""
+    def __init__(self, latency_ms=600.0, jitter=0.4, error_rate=0.0, error_status=503, retry_after=None,
+                 cold_start_sec=0.0, idle_sec=300.0, token_ms=20.0, batch=True, seed=None):
+        self.latency_ms = latency_ms          # 応答時間の中央値
+        self.jitter = jitter                  # 対数正規の sigma（0 なら一定）
+        self.error_rate = error_rate          # この割合で error_status を返す
+        self.error_status = error_status
+        self.retry_after = retry_after        # エラー時に付ける Retry-After（秒）
+        self.cold_start_sec = cold_start_sec  # 起動直後・idle_sec 以上空いた後の最初のリクエストに上乗せ
+        self.idle_sec = idle_sec
+        self.token_ms = token_ms              # ストリーミング時のトークン間隔
+        self.batch = batch                    # False なら /generate_batch は 404
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._last_request = None
+        self.stats = {"generate": 0, "generate_batch": 0, "prompts": 0, "errors": 0, "cold_starts": 0,
+                      "prompt_chars": 0, "reused_prefix_chars": 0}
+        self._last_prompt = {}   # conversation_id -> 前回のプロンプト
+
+    def note_prompt(self, prompt, conversation_id=None):
+        """同じ会話の前回プロンプトと一致する先頭の文字数を数える"""
+        with self._lock:
+            self.stats["prompt_chars"] += len(prompt)
+            if conversation_id:
+                prev = self._last_prompt.get(conversation_id, "")
+                self.stats["reused_prefix_chars"] += len(os.path.commonprefix([prev, prompt]))
+                self._last_prompt[conversation_id] = prompt
+
+    def sample(self, kind, n_prompts=1):
+        """1リクエスト分の (待ち秒数, エラーにするか) を決める"""
+        with self._lock:
+            now = time.monotonic()
+            cold = self.cold_start_sec > 0 and (self._last_request is None or now - self._last_request >= self.idle_sec)
+            self._last_request = now
+            delay = self.latency_ms / 1000.0
+            if self.jitter > 0:
+                delay *= math.exp(self.rng.gauss(0.0, self.jitter))
+            if kind == "generate_batch":
+                delay *= 1.0 + 0.15 * (n_prompts - 1)   # バッチは件数に応じて少しだけ遅くなる
+            fail = self.rng.random() < self.error_rate
+            self.stats[kind] += 1
+            self.stats["prompts"] += n_prompts
+            self.stats["errors"] += int(fail)
+            self.stats["cold_starts"] += int(cold)
+        return delay + (self.cold_start_sec if cold else 0.0), fail
+
+
+def mock_reply(prompt):
+    """プロンプトから決まる返答（同じプロンプトなら同じ文）"""
+    h = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+    last_line = [ln for ln in prompt.strip().splitlines() if ln.strip()][-2:-1] or [""]
+    words = [w.strip(".,!?\"'") for w in last_line[0].split()[1:] if len(w) > 3]
+    topic = " ".join(words[:3]).lower() or "this"
+    return " ".join([
+        REPLY_OPENERS[h % len(REPLY_OPENERS)].format(topic=topic),
+        REPLY_TIPS[(h >> 8) % len(REPLY_TIPS)],
+        REPLY_QUESTIONS[(h >> 16) % len(REPLY_QUESTIONS)],
+    ])
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive（クライアントのコネクションプールを効かせる）
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self):
+        headers = {}
+        if self.config.retry_after is not None:
+            headers["Retry-After"] = str(self.config.retry_after)
+        self._send_json(self.config.error_status, {"error": "mock failure"}, headers)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with self.config._lock:
+                self._send_json(200, dict(self.config.stats))
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = self._read_json()
+        if body is None:
+            self._send_json(400, {"error": "invalid json"})
+        elif self.path == "/generate":
+            self._generate(body)
+        elif self.path == "/generate_batch" and self.config.batch:
+            self._generate_batch(body)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def _generate(self, body):
+        delay, fail = self.config.sample("generate")
+        if fail:
+            time.sleep(delay * 0.2)
+            self._send_error()
+            return
+        prompt = str(body.get("prompt", ""))
+        self.config.note_prompt(prompt, body.get("conversation_id"))
+        reply = mock_reply(prompt)
+        if body.get("stream") and "text/event-stream" in self.headers.get("Accept", ""):
+            self._stream(reply, delay)
+            return
+        time.sleep(delay)
+        self._send_json(200, {"response": reply})
+
+    def _stream(self, reply, delay):
+        # 最初のトークンまでに delay、その後は token_ms ごとに1語ずつ
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(delay)
+        words = reply.split(" ")
+        for i, word in enumerate(words):
+            token = word if i == 0 else " " + word
+            self._write_chunk(f"data: {json.dumps({'token': token})}\n\n")
+            time.sleep(self.config.token_ms / 1000.0)
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _generate_batch(self, body):
+        prompts = body.get("prompts")
+        if not isinstance(prompts, list):
+            self._send_json(400, {"error": "prompts must be a list"})
+            return
+        delay, fail = self.config.sample("generate_batch", max(1, len(prompts)))
+        if fail:
+            time.sleep(delay * 0.2)
+            self._send_error()
+            return
+        conversation_ids = body.get("conversation_ids") or [None] * len(prompts)
+        for p, c in zip(prompts, conversation_ids):
+            self.config.note_prompt(str(p), c)
+        time.sleep(delay)
+        self._send_json(200, {"responses": [mock_reply(str(p)) for p in prompts]})
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # クライアント側のプールが keep-alive 接続を閉じただけのものは無視する
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def make_server(host="127.0.0.1", port=8765, config=None):
+    """ThreadingHTTPServer を作る（port=0 なら空いているポート）。serve_forever は呼び出し側で"""
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config or MockConfig()})
+    return MockServer((host, port), handler)
+
+
+def start_in_thread(host="127.0.0.1", port=0, config=None):
+    """バックグラウンドスレッドで起動して (server, /generate の URL) を返す"""
+    server = make_server(host, port, config)
+    threading.Thread(target=server.serve_forever, name="mock-generate", daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/generate"
+
+
+def add_config_args(parser):
+    parser.add_argument("--latency-ms", type=float, default=600.0, help="応答時間の中央値 (ms)")
+    parser.add_argument("--jitter", type=float, default=0.4, help="応答時間のばらつき（対数正規の sigma）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="エラーを返す割合 (0-1)")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=float, default=None, help="エラー時の Retry-After（秒）")
+    parser.add_argument("--cold-start-sec", type=float, default=0.0, help="コールドスタート時の追加待ち（秒）")
+    parser.add_argument("--idle-sec", type=float, default=300.0, help="この秒数リクエストが無いと再びコールドスタート")
+    parser.add_argument("--token-ms", type=float, default=20.0, help="ストリーミングのトークン間隔 (ms)")
+    parser.add_argument("--no-batch", action="store_true", help="/generate_batch を 404 にする")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args):
+    return MockConfig(
+        latency_ms=args.latency_ms, jitter=args.jitter, error_rate=args.error_rate,
+        error_status=args.error_status, retry_after=args.retry_after,
+        cold_start_sec=args.cold_start_sec, idle_sec=args.idle_sec, token_ms=args.token_ms,
+        batch=not args.no_batch, seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the /generate API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_args(parser)
+    args = parser.parse_args()
+    server = make_server(args.host, args.port, config_from_args(args))
+    print(f"mock /generate listening on http://{args.host}:{server.server_address[1]}/generate")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# /generate に送るプロンプトの組み立て（Chat Session とシミュレーションで共通）
+# 並び順は「変わらないもの → 変わるもの」:
+#   1. SYSTEM_PROMPT（全員共通の固定文）
+#   2. ペルソナ（ユーザーごとに固定: Big Five スコア）
+#   3. 返答スタイル（条件・ターンで変わる: トーン指示）
+#   4. 直近の会話（毎ターン変わる）
+#   5. 今回のユーザー発話
+# 同じ会話の連続するターンで 1〜2 がバイト単位で一致するので、prefix キャッシュを持つバックエンドは
+# conversation_id ごとに KV を使い回せる。インデントや末尾の空白は入れない。
+
+SYSTEM_PROMPT = """You are a warm, supportive mental health assistant.
+Write a natural, conversational response in 2–3 sentences:
+- Acknowledge the user's concern using their own words.
+- Ask ONE relevant question to keep the conversation going.
+- Suggest ONE practical coping tip based on their personality and briefly explain why it helps.
+Avoid sounding like a list. Make it flow like a real chat.
+Avoid phrases like "I understand" or "That sounds tough".
+Keep it empathetic, practical, and conversational."""
+
+PERSONA_TRAITS = ["Extraversion", "Agreeableness", "Conscientiousness", "Emotional Stability", "Openness"]
+CONTEXT_MESSAGES = 4   # 直近の発話数（User/AI 2往復分）
+
+
+def persona_block(profile):
+    summary = ", ".join(f"{t}={profile.get(t, 'N/A')}" for t in PERSONA_TRAITS)
+    return f"User personality (Big Five, 0-100): {summary}"
+
+
+def style_block(tone_instruction):
+    return f"Reflect this personality style: {tone_instruction.strip()}"
+
+
+def context_block(chat_history, n=CONTEXT_MESSAGES):
+    lines = [f"{m['role']}: {m['content']}" for m in chat_history[-n:]] if n > 0 else []
+    return "\n".join(["Conversation so far:", *lines])
+
+
+def build_turn_prompt(profile, tone_instruction, chat_history, user_message):
+    """1ターン分のプロンプト（固定部分が先頭に来る順で連結）"""
+    return "\n\n".join([
+        SYSTEM_PROMPT,
+        persona_block(profile),
+        style_block(tone_instruction),
+        context_block(chat_history),
+        f"User: {user_message.strip()}\nAssistant:",
+    ])
@@ -0,0 +1,334 @@
+# シミュレーションの割り当てを事前に書き出す「マニフェスト」と、その分割実行・結果の結合
+# 実行時に決めていたもの（DISJOINT_PTR / next_slow_seq によるユーザー名、rng による中心、
+# 登録人数の偶奇による条件、SessionID）を build で全部決めて JSON に書く。
+# 各シャードは共有の可変状態（ポインタ・連番・登録人数）を読まないので、別々のマシンで同時に実行できる。
+# 使い方:
+#   python sim_manifest.py build --mode disjoint --users 200 --shards 4 --out runs/plan.json
+#   python sim_manifest.py run runs/plan.shard-1-of-4.json --threads 4 --rps 1      # マシンごとに1シャード
+#   python sim_manifest.py merge runs/plan.json runs/plan.shard-*.results.jsonl --out-dir runs/merged
+# build は割り当てた範囲の DISJOINT_PTR / SLOW_SEQ を SIM_META で先に進める（画面や sim_runner.py と重ならない）。
+# run はターンのログを通常どおり LOGS_* に送り、ユーザーが終わるたびにその行を結果ファイル（JSONL）にも書く。
+# merge はマニフェストの順（ユーザー → ターン → User/AI）に並べ直して、シートごとの CSV にする。
+import argparse
+import csv
+import glob
+import json
+import os
+import random
+import sys
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+MANIFEST_VERSION = 1
+ROLE_ORDER = {"User": 0, "AI": 1}
+
+
+def shard_path(path, k, n):
+    """plan.json -> plan.shard-{k}-of-{n}.json（k は 1 始まり）"""
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.shard-{k}-of-{n}{ext or '.json'}"
+
+
+def results_path(path):
+    stem, _ = os.path.splitext(path)
+    return f"{stem}.results.jsonl"
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+# === build ===
+def _assign_conditions(core, users):
+    """
+    登録済みのユーザーはその条件・SessionID のまま、新しいユーザーは登録人数の偶奇で交互に割り当てる
+    （画面で1人ずつ登録した場合と同じ結果。途中まで進んだユーザーはチェックポイントの SessionID を引き継ぐ）
+    """
+    store = core.get_profile_store()
+    store.sync()
+    count = store.count()
+    for u in users:
+        existing = core.get_profile(u["username"])
+        ckp = core.read_checkpoint(u["username"])
+        u["session_id"] = (ckp or {}).get("session_id") or str(uuid.uuid4())
+        if existing and existing.get("ExperimentCondition"):
+            u["experiment_condition"] = existing["ExperimentCondition"]
+            continue
+        u["experiment_condition"] = "Fixed Empathy" if count % 2 == 0 else "Personalized Empathy"
+        count += 1
+
+
+def build_disjoint_users(core, df, args, start):
+    plan = core.get_disjoint_plan(df, core.big5_dataset_key(), batch_size=args.turns, seed=args.seed)
+    conflict = core.disjoint_plan_conflict(plan, start, core.get_sim_state_store().get("DISJOINT_PLAN"))
+    if conflict and not args.force:
+        sys.exit(f"{conflict} Use --force to assign from the current plan anyway.")
+    end = len(plan) if args.all else min(start + args.users, len(plan))
+    users = []
+    for bidx in range(start, end):
+        b = plan.batch(bidx)
+        users.append({
+            "username": f"Group {b['group_id']} Simulated User {b['user_index']}",
+            "group_id": b["group_id"], "user_index": b["user_index"], "center": b["center"],
+            "row_ids": b["row_ids"].tolist(), "source": "simulation_disjoint", "batch": bidx,
+        })
+    return users, end, {"plan": plan.fingerprint}
+
+
+def build_window_users(core, df, args, start):
+    """画面の ±window モードと同じ手順（連番 → ユーザー名、rng で中心を選び TraitIndex から行を選ぶ）"""
+    group_max = 65
+    rng = random.Random(args.seed)
+    index = core.get_trait_index(df, core.big5_dataset_key())
+    users = []
+    for i in range(args.users):
+        seq = start + i + 1
+        group_id, user_index = (seq - 1) // group_max + 1, (seq - 1) % group_max + 1
+        row = df.iloc[rng.randrange(0, len(df))]
+        center = {t: core.to_bins(row[t], step=args.window) for t in core.BIG5_TRAITS}
+        row_ids = index.query(center, window=args.window)
+        if len(row_ids) == 0:
+            print(f"skip Group {group_id} Simulated User {user_index}: no samples in ±{args.window} for {center}")
+            continue   # 画面と同じく連番は使ったまま
+        users.append({
+            "username": f"Group {group_id} Simulated User {user_index}",
+            "group_id": group_id, "user_index": user_index, "center": center,
+            "row_ids": core.sample_group_row_ids(row_ids, min_count=args.turns, seed=100 + i).tolist(),
+            "source": "simulation", "seq": seq,
+        })
+    return users, start + args.users, {"window": args.window}
+
+
+def cmd_build(args):
+    import chat_core as core
+
+    df = core.load_big5chat()
+    state = core.get_sim_state_store()
+    state.refresh()
+    pointer_key = "DISJOINT_PTR" if args.mode == "disjoint" else "SLOW_SEQ"
+    start = args.start if args.start is not None else (state.get_int(pointer_key) or 0)
+
+    build = build_disjoint_users if args.mode == "disjoint" else build_window_users
+    users, end, extra = build(core, df, args, start)
+    if not users:
+        sys.exit(f"nothing to assign from {pointer_key}={start}")
+    _assign_conditions(core, users)
+    for i, u in enumerate(users):
+        u["index"] = i   # マニフェスト内の順番（merge の並び順）
+
+    manifest_id = f"{args.mode}-{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+    shards = max(1, args.shards)
+    manifest = {
+        "version": MANIFEST_VERSION, "manifest_id": manifest_id, "mode": args.mode,
+        "dataset": core.big5_dataset_digest(*core.big5_dataset_key()),
+        "turns": args.turns, "flip_after": args.flip_after, "seed": args.seed,
+        "range": [start, end], "shards": shards, "created": datetime.utcnow().isoformat(), **extra,
+        "users": users,
+    }
+    write_json(args.out, manifest)
+    for k in range(1, shards + 1):
+        write_json(shard_path(args.out, k, shards), {**manifest, "shard": k, "users": users[k - 1::shards]})
+
+    if not args.no_reserve:
+        # 割り当てた範囲を先に進めておく（以降の画面・sim_runner.py・別のマニフェストと重ならない）
+        items = {
+            pointer_key: max(end, state.get_int(pointer_key) or 0),
+            f"MANIFEST:{manifest_id}": json.dumps({"range": [start, end], "users": len(users), "shards": shards}),
+        }
+        if args.mode == "disjoint" and (start == 0 or args.force):
+            items["DISJOINT_PLAN"] = manifest["plan"]   # sim_runner.py と同じく、最初からか --force のときだけ記録
+        state.set_many(items)
+    fixed = sum(u["experiment_condition"] == "Fixed Empathy" for u in users)
+    print(f"{manifest_id}: {len(users)} users ({fixed} Fixed / {len(users) - fixed} Personalized), "
+          f"{pointer_key} {start}..{end}, {shards} shard(s) -> {args.out}")
+
+
+# === run ===
+def cmd_run(args):
+    import chat_core as core
+
+    manifest = read_json(args.manifest)
+    df = core.load_big5chat()
+    digest = core.big5_dataset_digest(*core.big5_dataset_key())
+    if manifest["dataset"] != digest:
+        sys.exit(f"dataset mismatch: manifest was built from {manifest['dataset'][:16]}, local CSV is {digest[:16]}")
+    out = args.results or results_path(args.manifest)
+    done = set()
+    if os.path.exists(out):
+        with open(out, encoding="utf-8") as f:
+            done = {json.loads(line)["username"] for line in f if line.strip()}
+    todo = [u for u in manifest["users"] if u["username"] not in done]
+    print(f"{manifest['manifest_id']} shard {manifest.get('shard', '-')}/{manifest['shards']}: "
+          f"{len(todo)} to run, {len(done)} already in {out}", flush=True)
+    crisis = df["crisis"].to_numpy(dtype=bool)
+    started = []     # run_simulations_concurrently の通し番号 -> マニフェストのユーザー
+    conflicts = []   # 同じユーザー名が別の SessionID で既に進んでいる（別のマニフェスト・画面での実行）
+
+    def jobs():
+        for u in todo:
+            others = core.other_sessions(u["username"], u["session_id"])
+            if others:
+                conflicts.append(u["username"])
+                print(f"SKIP {u['username']}: already simulated under session {others[0]}", flush=True)
+                continue
+            started.append(u)
+            profile_dict = core.build_profile_from_center(u["center"])
+            core.ensure_personality_row(
+                username=u["username"], session_id=u["session_id"], experiment_condition=u["experiment_condition"],
+                profile_dict=profile_dict,
+                responses_json=json.dumps({"source": u["source"], "group": u["group_id"], "user_index": u["user_index"],
+                                           "manifest": manifest["manifest_id"]}),
+            )
+            core.get_user_log_ws_cached(u["username"], matched=False, experiment_condition=u["experiment_condition"])
+            if u["experiment_condition"] == "Personalized Empathy":
+                core.get_user_log_ws_cached(u["username"], matched=True, experiment_condition=u["experiment_condition"])
+            row_ids = np.asarray(u["row_ids"], dtype=np.int32)
+            yield {
+                "username": u["username"],
+                "profile_dict": profile_dict,
+                "user_inputs": core.DatasetTexts(df["text"], row_ids),
+                "session_id": u["session_id"],
+                "flip_after": manifest["flip_after"],
+                "experiment_condition": u["experiment_condition"],
+                "crisis": crisis[row_ids],
+                "resume": True,
+            }
+
+    failed = []
+    with open(out, "a", encoding="utf-8") as results:
+        def on_done(i, job, error):
+            u = started[i]
+            if error is not None:
+                failed.append(u["username"])
+                print(f"FAILED {u['username']}: {error!r}", flush=True)
+                return
+            rows = core.get_log_pipeline().turn_log.session_rows(u["username"], u["session_id"])
+            results.write(json.dumps({"manifest_id": manifest["manifest_id"], "index": u["index"],
+                                      "username": u["username"], "session_id": u["session_id"],
+                                      "rows": rows}, ensure_ascii=False) + "\n")
+            results.flush()
+            print(f"done {u['username']} ({len(rows)} rows)", flush=True)
+
+        core.run_simulations_concurrently(
+            jobs(),
+            max_workers=args.threads,
+            requests_per_sec=args.rps,
+            delay_sec=args.delay,
+            on_done=on_done,
+            cache=core.get_response_cache() if args.response_cache else None,
+            batch_size=args.batch_size,
+            batch_wait_sec=args.batch_wait_ms / 1000.0,
+        )
+    core.get_log_pipeline().shutdown()
+    print(f"finished: {len(started) - len(failed)} ok, {len(failed)} failed, {len(conflicts)} skipped -> {out}")
+    if failed or conflicts:
+        sys.exit(1)
+
+
+# === merge ===
+def cmd_merge(args):
+    import chat_core as core
+
+    manifest = read_json(args.manifest)
+    by_user = {}   # username -> 結果（同じユーザーが複数あれば行の多いもの、同数なら先に読んだファイル）
+    paths = sorted({p for pattern in args.results for p in (glob.glob(pattern) or [pattern])})
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                r = json.loads(line)
+                if r.get("manifest_id") != manifest["manifest_id"]:
+                    continue
+                prev = by_user.get(r["username"])
+                if prev is None or len(r["rows"]) > len(prev["rows"]):
+                    by_user[r["username"]] = r
+
+    sheets = {}    # シート名 -> 行（マニフェスト順 → ターン → User/AI）
+    missing, short = [], []
+    for u in manifest["users"]:
+        r = by_user.get(u["username"])
+        if r is None:
+            missing.append(u["username"])
+            continue
+        seen, rows = set(), []
+        for sheet, row in r["rows"]:
+            key = (sheet, int(row[7]), row[2])   # Turn, Role
+            if key not in seen:                  # 再送で重複した行は先に書いたものを残す
+                seen.add(key)
+                rows.append((int(row[7]), ROLE_ORDER.get(row[2], 9), sheet, row))
+        if len(rows) < 2 * manifest["turns"]:
+            short.append(f"{u['username']} ({len(rows)} rows)")
+        for _, _, sheet, row in sorted(rows, key=lambda x: (x[0], x[1])):
+            sheets.setdefault(sheet, []).append(row)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for sheet in sorted(sheets):
+        with open(os.path.join(args.out_dir, f"{sheet}.csv"), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(core.LOG_HEADER)
+            writer.writerows(sheets[sheet])
+    print(f"{manifest['manifest_id']}: {len(manifest['users']) - len(missing)}/{len(manifest['users'])} users, "
+          + ", ".join(f"{s} {len(rows)} rows" for s, rows in sorted(sheets.items())) + f" -> {args.out_dir}")
+    if short:
+        print("incomplete: " + "; ".join(short))
+    if missing:
+        print(f"missing {len(missing)} users: " + ", ".join(missing[:10]) + (" ..." if len(missing) > 10 else ""))
+        if not args.allow_partial:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build, run and merge sharded simulation manifests")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    b = sub.add_parser("build", help="割り当てを決めてマニフェストとシャードを書き出す")
+    b.add_argument("--mode", choices=["disjoint", "window"], default="disjoint")
+    b.add_argument("--users", type=int, default=1)
+    b.add_argument("--all", action="store_true", help="disjoint: 残りのバッチをすべて割り当てる")
+    b.add_argument("--start", type=int, default=None, help="DISJOINT_PTR / SLOW_SEQ の代わりにここから割り当てる")
+    b.add_argument("--no-reserve", action="store_true", help="SIM_META の DISJOINT_PTR / SLOW_SEQ を進めない")
+    b.add_argument("--turns", type=int, default=60)
+    b.add_argument("--flip-after", type=int, default=30)
+    b.add_argument("--seed", type=int, default=42)
+    b.add_argument("--window", type=int, default=10, help="window: 特性の ±幅（画面の Trait window）")
+    b.add_argument("--shards", type=int, default=1)
+    b.add_argument("--force", action="store_true", help="disjoint: DISJOINT_PTR を記録したプランと今のプランが違っても割り当てる")
+    b.add_argument("--out", required=True)
+    b.set_defaults(func=cmd_build)
+
+    r = sub.add_parser("run", help="マニフェスト（またはシャード）1つを実行する")
+    r.add_argument("manifest")
+    r.add_argument("--results", default=None, help="結果の JSONL（既定: <manifest>.results.jsonl。再実行時は済んだユーザーを飛ばす）")
+    r.add_argument("--threads", type=int, default=4, help="同時に走らせる擬似ユーザー数")
+    r.add_argument("--rps", type=float, default=1.0, help="このシャードの API 呼び出しの上限")
+    r.add_argument("--delay", type=float, default=2.0, help="ユーザー内のターン間の待ち（秒）")
+    r.add_argument("--batch-size", type=int, default=1, help="/generate_batch にまとめる件数（1 = しない）")
+    r.add_argument("--batch-wait-ms", type=float, default=50.0)
+    r.add_argument("--response-cache", action="store_true")
+    r.set_defaults(func=cmd_run)
+
+    m = sub.add_parser("merge", help="シャードの結果をマニフェストの順に結合してシートごとの CSV にする")
+    m.add_argument("manifest", help="build --out で書いた全体のマニフェスト")
+    m.add_argument("results", nargs="+", help="run の結果 JSONL（glob 可）")
+    m.add_argument("--out-dir", required=True)
+    m.add_argument("--allow-partial", action="store_true", help="結果の無いユーザーがいても書き出す")
+    m.set_defaults(func=cmd_merge)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+# Big5Chat の disjoint シミュレーションをブラウザなしで回すコマンドライン版
+# 管理画面の「Run Big5Chat Simulation」と同じ処理（load_big5chat → get_disjoint_plan → ensure_personality_row
+# → run_simulation_for_user_slow → log_chat_to_sheet）を、ワーカープロセスのプールで実行する。
+#   - 各ワーカーは共有のポインタから次のバッチ番号を1つずつ取り、プロセス内のスレッドでユーザーを並列に回す
+#   - 進捗（DISJOINT_PTR・RUNNER_STATUS）を SIM_META に書くのは親プロセスだけ。管理画面はそれを表示する
+#   - ログは全プロセス共通のローカル WAL に書かれ、リースを持つ1プロセスが Sheets に複製する
+#   - 途中で止めても、次回は DISJOINT_PTR とチェックポイント／WAL から続きを実行する
+# 使い方:
+#   python sim_runner.py --processes 2 --threads 4 --rps 2 --users 20
+#   python sim_runner.py --all --processes 4 --threads 4 --rps 4 --batch-size 8
+#   GEN_API_URL=http://127.0.0.1:8765/generate SHEETS_BACKEND=memory python sim_runner.py --processes 0 --users 2
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+
+
+class NameConflict(Exception):
+    """バッチのユーザー名が別のモード・別のセッションで既に使われている（このバッチは回さない）"""
+
+
+def disjoint_job(core, df, plan, bidx, registration_lock):
+    """
+    バッチ bidx の擬似ユーザーを登録して run_simulation_for_user_slow の引数を返す。
+    条件の交互割当（登録済み人数の偶奇）がプロセス間でずれないよう、登録は registration_lock の中で行う。
+    ユーザー名は window モードと同じ形式なので、名前が別のモード・別のセッションで使われていたら NameConflict。
+    """
+    b = plan.batch(bidx)
+    username = f"Group {b['group_id']} Simulated User {b['user_index']}"
+    profile_dict = core.build_profile_from_center(b["center"])
+    store = core.get_profile_store()
+    with registration_lock:
+        store.sync()   # 他のワーカーが登録した行を読み足してから数える
+        # 中断後の再実行で登録済みのユーザーは、登録時の SessionID・条件のまま続ける
+        existing = core.get_profile(username)
+        if existing is not None:
+            try:
+                source = json.loads(existing.get("Responses") or "{}").get("source")
+            except (TypeError, ValueError, AttributeError):
+                source = None
+            if source != "simulation_disjoint":
+                raise NameConflict(f"{username} is already registered by another mode ({source or 'unknown'})")
+        session_id = str((existing or {}).get("SessionID") or "") or str(uuid.uuid4())
+        others = core.other_sessions(username, session_id)
+        if others:
+            raise NameConflict(f"{username} was already simulated under session {others[0]}")
+        experiment_condition = (existing or {}).get("ExperimentCondition") or (
+            "Fixed Empathy" if (store.count() % 2 == 0) else "Personalized Empathy"
+        )
+        core.ensure_personality_row(
+            username=username,
+            session_id=session_id,
+            experiment_condition=experiment_condition,
+            profile_dict=profile_dict,
+            responses_json=json.dumps({"source": "simulation_disjoint", "group": b["group_id"], "user_index": b["user_index"]}),
+        )
+
+    # ログ用のシートを先に作っておく（切替時も安定）
+    core.get_user_log_ws_cached(username, matched=False, experiment_condition=experiment_condition)
+    if experiment_condition == "Personalized Empathy":
+        core.get_user_log_ws_cached(username, matched=True, experiment_condition=experiment_condition)
+
+    return {
+        "username": username,
+        "profile_dict": profile_dict,
+        "user_inputs": plan.texts(df, bidx),   # 本文はターン実行時にデータセットから読む
+        "session_id": session_id,
+        "flip_after": 30,
+        "experiment_condition": experiment_condition,
+        "crisis": b["crisis"],
+        "resume": True,
+    }
+
+
+def worker_main(slot, opts, claim, end_ptr, registration_lock, stop, events, child=True):
+    """
+    ワーカー1つ分。claim（共有の次のバッチ番号）から取れるだけ取り、opts["threads"] 人ずつ並列に回す。
+    events には ("claimed" | "done" | "exit", ...) を送る（親プロセスが進捗にまとめる）。
+    """
+    if child:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)   # Ctrl-C は親が受けて、新しいバッチを取るのを止める
+    import chat_core as core
+
+    df = core.load_big5chat()
+    plan = core.get_disjoint_plan(df, core.big5_dataset_key(), batch_size=opts["turns"], seed=opts["seed"])
+    claimed = []   # run_simulations_concurrently の通し番号 -> バッチ番号
+
+    def jobs():
+        while not stop.is_set():
+            with claim.get_lock():
+                bidx = claim.value
+                if bidx >= end_ptr:
+                    return
+                claim.value = bidx + 1
+            try:
+                job = disjoint_job(core, df, plan, bidx, registration_lock)
+            except NameConflict as e:
+                events.put(("conflict", slot, bidx, str(e)))
+                continue
+            except Exception as e:
+                events.put(("done", slot, bidx, f"Group ? (batch {bidx})", f"registration failed: {e!r}"))
+                continue
+            claimed.append(bidx)
+            events.put(("claimed", slot, bidx, job["username"]))
+            yield job
+
+    def on_done(i, job, error):
+        events.put(("done", slot, claimed[i], job["username"], None if error is None else repr(error)))
+
+    try:
+        core.run_simulations_concurrently(
+            jobs(),
+            max_workers=opts["threads"],
+            requests_per_sec=opts["rps_per_worker"],
+            delay_sec=opts["delay"],
+            on_done=on_done,
+            cache=core.get_response_cache() if opts["response_cache"] else None,
+            batch_size=opts["batch_size"],
+            batch_wait_sec=opts["batch_wait_ms"] / 1000.0,
+        )
+    finally:
+        pipeline = core.get_log_pipeline()
+        pipeline.shutdown()
+        events.put(("exit", slot, pipeline.stats()))
+
+
+class Progress:
+    """親プロセス側の進捗。DISJOINT_PTR は「先頭から連続して終わった所」まで進める（終わる順は前後する）"""
+    def __init__(self, core, plan_id, start_ptr, end_ptr, processes, threads):
+        self.core = core
+        self.ptr = start_ptr
+        self.finished = set()
+        self.running = {}   # バッチ番号 -> username
+        self.failed = []
+        self.conflicts = []   # 名前の衝突で回さなかったバッチ
+        self.status = {
+            "state": "running", "host": socket.gethostname(), "pid": os.getpid(), "plan": plan_id,
+            "processes": processes, "threads": threads, "start_ptr": start_ptr, "end_ptr": end_ptr,
+            "started": time.time(),
+        }
+        self._last_write = 0.0
+
+    def on_event(self, event):
+        kind, slot = event[0], event[1]
+        if kind == "claimed":
+            _, _, bidx, username = event
+            self.running[bidx] = username
+            print(f"[worker {slot}] start {username} (batch {bidx})", flush=True)
+        elif kind == "conflict":
+            _, _, bidx, message = event
+            self.conflicts.append(bidx)
+            print(f"[worker {slot}] SKIP batch {bidx}: {message}", flush=True)
+            self._finish(bidx)
+        elif kind == "done":
+            _, _, bidx, username, error = event
+            self.running.pop(bidx, None)
+            if error is not None:
+                self.failed.append(username)
+                print(f"[worker {slot}] FAILED {username}: {error}", flush=True)
+            else:
+                print(f"[worker {slot}] done {username}", flush=True)
+            self._finish(bidx)
+
+    def _finish(self, bidx):
+        self.finished.add(bidx)
+        if self.ptr in self.finished:
+            while self.ptr in self.finished:
+                self.ptr += 1
+            self.write()
+
+    def write(self, state=None, force=True):
+        """DISJOINT_PTR と RUNNER_STATUS を set_many 1回で書く（force=False なら RUNNER_HEARTBEAT_SEC ごと）"""
+        now = time.time()
+        if not force and now - self._last_write < self.core.RUNNER_HEARTBEAT_SEC:
+            return
+        if state is not None:
+            self.status["state"] = state
+        self.status.update({
+            "ptr": self.ptr, "done": len(self.finished), "failed": len(self.failed), "conflicts": self.conflicts,
+            "running": sorted(self.running.values()), "updated": now,
+        })
+        items = {"DISJOINT_PTR": self.ptr, self.core.RUNNER_STATUS_KEY: json.dumps(self.status, ensure_ascii=False)}
+        if self.failed:
+            items["FAILED_USER"] = self.failed[-1]
+        self.core.get_sim_state_store().set_many(items)
+        self._last_write = now
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the disjoint Big5Chat simulation without a browser session")
+    parser.add_argument("--users", type=int, default=1, help="この実行で回す擬似ユーザー数（バッチ数）")
+    parser.add_argument("--all", action="store_true", help="残りのバッチをすべて回す")
+    parser.add_argument("--processes", type=int, default=2,
+                        help="ワーカープロセス数（0 = このプロセス内のスレッドだけ。memory バックエンドは常に 0）")
+    parser.add_argument("--threads", type=int, default=4, help="1プロセスで同時に走らせる擬似ユーザー数")
+    parser.add_argument("--rps", type=float, default=1.0, help="API 呼び出しの上限（全プロセス合計）")
+    parser.add_argument("--delay", type=float, default=2.0, help="ユーザー内のターン間の待ち（秒）")
+    parser.add_argument("--batch-size", type=int, default=1, help="/generate_batch にまとめる件数（1 = しない）")
+    parser.add_argument("--batch-wait-ms", type=float, default=50.0)
+    parser.add_argument("--response-cache", action="store_true", help="応答キャッシュ（ディスク）を使う")
+    parser.add_argument("--turns", type=int, default=60, help="1ユーザーのターン数（= バッチの件数）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--force", action="store_true", help="別のランナーが動いていそうでも、DISJOINT_PTR を記録したプランと今のプランが違っても起動する")
+    args = parser.parse_args()
+
+    import chat_core as core
+
+    processes = max(0, args.processes)
+    if core.SHEETS_BACKEND != "gspread" and processes > 0:
+        print("memory backend: sheets are per process, running workers as threads in this process", flush=True)
+        processes = 0
+
+    # データセットとバッチ計画はここで作っておく（ワーカーはディスクのキャッシュを読むだけになる）
+    df = core.load_big5chat()
+    plan = core.get_disjoint_plan(df, core.big5_dataset_key(), batch_size=args.turns, seed=args.seed)
+    store = core.get_sim_state_store()
+    store.refresh()
+
+    status = core.read_runner_status()
+    if status is not None and status["alive"] and not args.force:
+        sys.exit(f"another runner looks active ({status.get('host')} pid {status.get('pid')}, "
+                 f"updated {status['age_sec']}s ago). Use --force to start anyway.")
+    ptr = store.get_int("DISJOINT_PTR", 0)
+    conflict = core.disjoint_plan_conflict(plan, ptr, store.get("DISJOINT_PLAN"))
+    if conflict and not args.force:
+        sys.exit(f"{conflict} Use --force to continue with the current plan anyway.")
+    if conflict:
+        print(f"warning: {conflict} Continuing (--force).", flush=True)
+    if ptr == 0 or conflict:
+        # 記録するのは最初から始めるとき、または --force で今のプランを受け入れたときだけ
+        core.write_sim_state("DISJOINT_PLAN", plan.fingerprint)
+
+    end_ptr = len(plan) if args.all else min(ptr + max(0, args.users), len(plan))
+    if ptr >= end_ptr:
+        print(f"nothing to do: {ptr} / {len(plan)} batches finished")
+        return
+    n_workers = max(1, processes)
+    threads = max(1, args.threads)
+    opts = {
+        "turns": args.turns, "seed": args.seed, "threads": threads,
+        "rps_per_worker": args.rps / n_workers, "delay": args.delay,
+        "batch_size": args.batch_size, "batch_wait_ms": args.batch_wait_ms, "response_cache": args.response_cache,
+    }
+    print(f"batches {ptr}..{end_ptr - 1} of {len(plan)} | API calls {plan.api_budget(ptr, end_ptr)} | "
+          f"{n_workers} worker(s) x {threads} threads", flush=True)
+
+    progress = Progress(core, plan.fingerprint, ptr, end_ptr, processes, threads)
+    progress.write()
+
+    # ワーカー間で共有するもの（spawn: 子は chat_core を import し直すので、親のスレッドや接続を引き継がない）
+    ctx = mp.get_context("spawn")
+    claim = ctx.Value("l", ptr)
+    registration_lock = ctx.Lock()
+    stop = ctx.Event()
+    events = ctx.Queue()
+    if processes > 0:
+        workers = [ctx.Process(target=worker_main, name=f"sim-worker-{i}",
+                               args=(i, opts, claim, end_ptr, registration_lock, stop, events))
+                   for i in range(processes)]
+    else:
+        workers = [threading.Thread(target=worker_main, name="sim-worker-0", daemon=True,
+                                    args=(0, opts, claim, end_ptr, registration_lock, stop, events, False))]
+    for w in workers:
+        w.start()
+
+    def request_stop(signum, frame):
+        if stop.is_set():
+            print("stopping now (unfinished users resume from their checkpoints next time)", flush=True)
+            for w in workers:
+                if isinstance(w, mp.process.BaseProcess):
+                    w.terminate()
+            raise KeyboardInterrupt
+        print("stopping after the users in progress finish (Ctrl-C again to stop now)", flush=True)
+        stop.set()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    exited = 0
+    try:
+        while exited < len(workers):
+            try:
+                event = events.get(timeout=1.0)
+            except queue.Empty:
+                if not any(w.is_alive() for w in workers):
+                    break   # 終了イベントを送れずに落ちたワーカー
+                progress.write(force=False)
+                continue
+            if event[0] == "exit":
+                exited += 1
+                print(f"[worker {event[1]}] exit | log {event[2]}", flush=True)
+            else:
+                progress.on_event(event)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for w in workers:
+            w.join(timeout=5)
+        progress.write(state="finished" if progress.ptr >= end_ptr else "stopped")
+        print(f"progress {progress.ptr} / {len(plan)} batches | done {len(progress.finished)} | "
+              f"failed {len(progress.failed)} | skipped (name conflict) {len(progress.conflicts)}", flush=True)
+    if progress.conflicts:
+        sys.exit(f"batches {progress.conflicts} were not simulated: their usernames are taken by another mode or session")
+
+
+if __name__ == "__main__":
+    main()
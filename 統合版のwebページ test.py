@@ -1,152 +1,44 @@
 import streamlit as st
 import gspread
 import json
-import tempfile
 from datetime import datetime
-from oauth2client.service_account import ServiceAccountCredentials
-import requests
 import uuid
-import time
 import random
 import math
-import pandas as pd
-
-# === Google Sheets 認証 ===
-creds_dict = st.secrets["GOOGLE_SERVICE_ACCOUNT_JSON"].to_dict()
-creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
-
-with tempfile.NamedTemporaryFile(delete=False, mode="w", suffix=".json") as tmp:
-    json.dump(creds_dict, tmp)
-    tmp_path = tmp.name
-
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-credentials = ServiceAccountCredentials.from_json_keyfile_name(tmp_path, scope)
-client = gspread.authorize(credentials)
-
-spreadsheet = client.open_by_key("1XpB4gzlkOS72uJMADmSIuvqECM5Ud8M-KwwJbXSxJxM")
-profile_sheet = spreadsheet.worksheet("Personality")
-
-
-# --- Worksheet & Profiles キャッシュ ---
-WS_CACHE_KEY = "_ws_cache"
-PROFILES_CACHE_KEY = "_profiles_cache"
-
-def get_user_log_ws_cached(username: str, matched: bool):
-    """
-    Fixed → LOGS_FIXED
-    Personalized → LOGS_PERS_NOMATCH / LOGS_PERS_MATCHED
-    """
-    exp_cond = st.session_state.get("experiment_condition", "Unknown")
-    if exp_cond == "Fixed Empathy":
-        sheet_name = "LOGS_FIXED"
-    else:
-        sheet_name = "LOGS_PERS_MATCHED" if matched else "LOGS_PERS_NOMATCH"
-
-    cache = st.session_state.get(WS_CACHE_KEY, {})
-    if sheet_name in cache:
-        return cache[sheet_name]
-
-    header = [
-        "SessionID","Username","Role","Message","Timestamp",
-        "ExperimentCondition","MatchedMode","Turn","Phase",
-        "GroupID","UserIndex","GroupUser",
-        # One-hot（必要なら残す／セル節約したいなら削除OK）
-        "Group 1","Group 2","Group 3","Group 4","Group 5",
-        "Group 6","Group 7","Group 8","Group 9","Group 10",
-        "Tone_E","Tone_A","Tone_C","Tone_ES","Tone_O"
-    ]
-
-    try:
-        ws = spreadsheet.worksheet(sheet_name)
-    except gspread.exceptions.WorksheetNotFound:
-        try:
-            ws = spreadsheet.add_worksheet(
-                title=sheet_name,
-                rows="5000",                       # 小さく開始（append_rowで自動拡張）
-                cols=str(len(header))              # ヘッダ分だけ確保
-            )
-            ws.append_row(header)
-        except gspread.exceptions.APIError as e:
-            # 競合で既に作られた可能性 → 取り直し
-            try:
-                ws = spreadsheet.worksheet(sheet_name)
-            except Exception:
-                raise e
-
-    cache[sheet_name] = ws
-    st.session_state[WS_CACHE_KEY] = cache
-    return ws
-
-
-
-
-def safe_append_ws(ws, row, retries=5, base_delay=2.0):
-    for i in range(retries):
-        try:
-            ws.append_row(row)
-            return
-        except gspread.exceptions.APIError:
-            time.sleep(base_delay * (i + 1))
-    st.error("Failed to append after multiple retries.")
-
-def get_all_profiles_cached(ttl_sec=60):
-    now = time.time()
-    cache = st.session_state.get(PROFILES_CACHE_KEY)
-    if cache and (now - cache["ts"] < ttl_sec):
-        return cache["rows"]
-    rows = profile_sheet.get_all_records()  # 実 Read はここ一回だけ
-    st.session_state[PROFILES_CACHE_KEY] = {"ts": now, "rows": rows}
-    return rows
-
-# ← ここは get_all_profiles_cached() の直後に入れる
-def invalidate_profiles_cache():
-    if PROFILES_CACHE_KEY in st.session_state:
-        del st.session_state[PROFILES_CACHE_KEY]
-
-def ensure_personality_row(username: str, session_id: str, experiment_condition: str, profile_dict: dict, responses_json: str = "{}"):
-    """
-    Personalityに同名ユーザーが無ければ1回だけ登録する。
-    """
-    rows = get_all_profiles_cached()
-    if any(r.get("Username") == username for r in rows):
-        return  # 既に登録済み
-
-    row = [
-        username,
-        session_id,
-        experiment_condition,
-        int(profile_dict.get("Extraversion", 50)),
-        int(profile_dict.get("Agreeableness", 50)),
-        int(profile_dict.get("Conscientiousness", 50)),
-        int(profile_dict.get("Emotional Stability", 50)),
-        int(profile_dict.get("Openness", 50)),
-        responses_json,
-    ]
-    safe_append(profile_sheet, row)
-    invalidate_profiles_cache()
-
-
-def log_chat_to_sheet(ws, session_id, username, user_msg, ai_msg,
-                      timestamp, experiment, matched_bool,
-                      turn, phase, group_id, user_index,
-                      tone_e=None, tone_a=None, tone_c=None, tone_es=None, tone_o=None):
-    matched_str = "Matched" if matched_bool else "NoMatch"
-    group_user = f"Group {group_id} Simulated User {user_index}"
-    onehot = [1 if (i+1) == int(group_id) else 0 for i in range(10)]
-
-    row_tail = [*onehot, tone_e, tone_a, tone_c, tone_es, tone_o]
-
-    safe_append_ws(ws, [
-        session_id, username, "User", user_msg, timestamp,
-        experiment, matched_str, turn, phase,
-        group_id, user_index, group_user, *row_tail
-    ])
-    safe_append_ws(ws, [
-        session_id, username, "AI", ai_msg, timestamp,
-        experiment, matched_str, turn, phase,
-        group_id, user_index, group_user, *row_tail
-    ])
 
+from chat_core import (
+    CHAT_STREAMING,
+    big5_dataset_key,
+    build_chat_prompt,
+    build_profile_from_center,
+    call_api,
+    clean_reply,
+    disjoint_plan_conflict,
+    ensure_personality_row,
+    get_disjoint_plan,
+    get_generation_client,
+    get_log_pipeline,
+    get_profile,
+    get_profile_store,
+    get_sim_state_store,
+    get_response_cache,
+    get_trait_index,
+    get_user_log_ws_cached,
+    get_worksheet,
+    handle_crisis,
+    load_big5chat,
+    log_chat_to_sheet,
+    make_user_inputs_from_group,
+    next_slow_seq,
+    prewarm_response_cache,
+    read_runner_status,
+    read_sim_state,
+    run_simulations_concurrently,
+    sheets_quota_stats,
+    strip_prompt_echo,
+    to_bins,
+    write_sim_state,
+)
 
 # === セッション管理 ===
 if "session_id" not in st.session_state:
@@ -168,365 +60,6 @@ if "turn_index" not in st.session_state:
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 
-# === Google Sheets 安全書き込み ===
-def safe_append(sheet, row, retries=3, delay=2):
-    for i in range(retries):
-        try:
-            sheet.append_row(row)
-            return
-        except gspread.exceptions.APIError:
-            time.sleep(delay * (i + 1))
-    st.error("Failed to log data after multiple retries.")
-
-def get_profile(user):
-    for row in get_all_profiles_cached():
-        if row.get("Username") == user:
-            return row
-    return None
-
-
-
-#Penley & Tomaka 2002, Carver & Connor-Smith 2010, Stewart 2000, Frontiers 2023
-# === Big Fiveトーン + 複合パターン対応 ===
-def determine_tone(profile, match=True):
-    def clamp01(x): return max(0, min(100, int(x)))
-
-    def flip(value): 
-        v = clamp01(value)
-        return 100 - v
-
-    def adjusted(trait): 
-        v = int(profile.get(trait, 50))
-        return v if match else flip(v)
-
-    ex = adjusted("Extraversion")
-    ag = adjusted("Agreeableness")
-    co = adjusted("Conscientiousness")
-    es = adjusted("Emotional Stability")
-    op = adjusted("Openness")
-
-    tone = "cheerful and engaging" if ex >= 60 else "calm and measured"
-    empathy = "warm and supportive" if ag >= 60 else "matter-of-fact but polite"
-    style = "clear and structured" if co >= 60 else "casual and flexible"
-    emotional = "steady and reassuring" if es >= 60 else "gentle and calming"
-    creativity = "curious and imaginative" if op >= 60 else "practical and simple"
-
-    suggestions_map = []
-    if es <= 40 and co <= 40:
-        suggestions_map.append("Try breaking big tasks into small steps and reframe stress as a challenge.")
-    if ex >= 60 and co <= 40:
-        suggestions_map.append("Plan a fun social activity that gives you energy but adds a little structure.")
-    if es <= 40 and ex <= 40:
-        suggestions_map.append("Express your feelings safely, like journaling, or try a mindfulness break.")
-    if ex >= 60 and co >= 60:
-        suggestions_map.append("Set a short-term goal and tackle it with a friend to stay motivated.")
-    if ag >= 60:
-        suggestions_map.append("Reach out to a supportive friend or help someone else—it can lift your mood.")
-    if op >= 60:
-        suggestions_map.append("Try a creative outlet like art or music, or explore a new hobby.")
-
-    if not suggestions_map:
-        suggestions_map.append("Offer practical coping ideas based on their personality.")
-    special_instruction = " ".join(random.sample(suggestions_map, min(2, len(suggestions_map))))
-
-    return {
-        "tone": tone,
-        "empathy": empathy,
-        "style": style,
-        "emotional": emotional,
-        "creativity": creativity,
-        "special_instruction": special_instruction,
-        # ★ 追加：実際に使った値
-        "used_traits": {"E": ex, "A": ag, "C": co, "ES": es, "O": op}
-    }
-
-
-# ==== ここから Big5Chat ベースの擬似ユーザー生成 & 自動会話シミュレーション ==== #
-
-BIG5_PATH = "data/big5_chat/big5_chat_dataset_prepped.csv"  # アップロード済みのパスに合わせて
-
-def load_big5chat():
-    import numpy as np
-    # 1) 読み込み（文字コードや区切りの揺れも吸収）
-    try:
-        df = pd.read_csv(BIG5_PATH)
-    except UnicodeDecodeError:
-        df = pd.read_csv(BIG5_PATH, encoding="utf-8-sig")
-    except Exception:
-        df = pd.read_csv(BIG5_PATH, sep=None, engine="python")
-
-    df.columns = [c.strip() for c in df.columns]
-
-    # 2) ユーザー発話列を推定して 'text' に統一
-    #    ← あなたのCSVヘッダに合わせて候補を拡張
-    text_candidates = [
-        "train_input", "narrative", "literal",  # ← 追加
-        "text", "utterance", "message", "user_text", "content", "sentence"
-    ]
-    text_col = next((c for c in text_candidates if c in df.columns), None)
-    if text_col is None:
-        st.error(f"発話列が見つかりません。候補={text_candidates} / 実列={list(df.columns)}")
-        st.stop()
-    if text_col != "text":
-        df = df.rename(columns={text_col: "text"})
-
-    # 3) Big5 列を準備（無ければ 50 で埋める）
-    big5 = ["Extraversion","Agreeableness","Conscientiousness","Emotional Stability","Openness"]
-    for t in big5:
-        if t not in df.columns:
-            df[t] = 50
-
-    # 4) trait/level がある場合は簡易に数値化（high=80, medium=50, low=20）して該当特性のみ上書き
-    trait_map = {
-        "e":"Extraversion","extraversion":"Extraversion",
-        "a":"Agreeableness","agreeableness":"Agreeableness",
-        "c":"Conscientiousness","conscientiousness":"Conscientiousness",
-        "n":"Emotional Stability","neuroticism":"Emotional Stability","emotional stability":"Emotional Stability",
-        "o":"Openness","openness":"Openness",
-    }
-    level_map = {"high":80, "medium":60, "mid":60, "low":20}
-    if "trait" in df.columns:
-        tseries = df["trait"].astype(str).str.strip().str.lower().map(trait_map)
-        if "level" in df.columns:
-            lseries = df["level"].astype(str).str.strip().str.lower().map(level_map).fillna(50)
-        else:
-            lseries = pd.Series(50, index=df.index)
-        for i, col in tseries.dropna().items():
-            if col in df.columns:
-                df.loc[i, col] = lseries.loc[i]
-
-    # 5) クリーニング
-    df["text"] = df["text"].astype(str).str.strip()
-    df = df[df["text"].str.len() > 0].reset_index(drop=True)
-    return df
-
-def build_disjoint_batches(df: pd.DataFrame, batch_size: int = 60, seed: int = 42):
-    """
-    Big5 の完全一致クラスタごとに行をシャッフルし、60件ずつ“重複ゼロ”のバッチに分割。
-    返り値: [{'group_id': 1..G, 'user_index': 1..U, 'texts': [...60件...], 'center': {...Big5}}] のリスト
-    """
-    traits = ["Extraversion","Agreeableness","Conscientiousness","Emotional Stability","Openness"]
-    # 特性の整数化（安全側）
-    for col in traits:
-        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(50).astype(int)
-
-    # 完全一致クラスタのインデックス辞書（中心タプル -> 行インデックス配列）
-    centers_df = df[traits].astype(int)
-    groups = centers_df.groupby(traits).indices   # dict: { (E,A,C,ES,O): np.ndarray([...]) }
-
-    # 安定順序で group_id を振る
-    sorted_centers = sorted(groups.keys())
-    rng = random.Random(seed)
-
-    batches = []
-    for gid, center in enumerate(sorted_centers, start=1):
-        idxs = list(groups[center])
-        rng.shuffle(idxs)  # シャッフル固定シード
-
-        # 60件ずつに切る（余りは捨てる）
-        full_len = len(idxs) - (len(idxs) % batch_size)
-        for uidx, start in enumerate(range(0, full_len, batch_size), start=1):
-            if uidx>65:
-                break
-            
-            batch_indices = idxs[start:start+batch_size]
-            texts = df.loc[batch_indices, "text"].astype(str).tolist()
-            center_dict = {
-                "Extraversion": center[0], "Agreeableness": center[1],
-                "Conscientiousness": center[2], "Emotional Stability": center[3],
-                "Openness": center[4],
-            }
-            batches.append({
-                "group_id": gid,
-                "user_index": uidx,
-                "texts": texts,
-                "center": center_dict
-            })
-
-    return batches
-
-
-def to_bins(score, step=10):
-    """0–100 のスコアを step 幅（±10 など）でビン化（例: step=10 なら 0,10,20,...）"""
-    try:
-        s = float(score)
-    except:
-        s = 50.0
-    s = max(0, min(100, s))
-    return int(round(s/step)*step)
-
-def group_by_trait_window(df, center, window=10):
-    """
-    center: {'Extraversion': 70,...} のような中心値
-    window: ±10 の範囲で類似サンプルを抽出
-    """
-    m = pd.Series(center)
-    cond = (
-        (df['Extraversion'].between(m['Extraversion']-window, m['Extraversion']+window)) &
-        (df['Agreeableness'].between(m['Agreeableness']-window, m['Agreeableness']+window)) &
-        (df['Conscientiousness'].between(m['Conscientiousness']-window, m['Conscientiousness']+window)) &
-        (df['Emotional Stability'].between(m['Emotional Stability']-window, m['Emotional Stability']+window)) &
-        (df['Openness'].between(m['Openness']-window, m['Openness']+window))
-    )
-    return df[cond].copy()
-
-def build_profile_from_center(center):
-    """
-    center（各特性 0–100）から、シートの Personality と同形式の dict を作る
-    """
-    return {
-        "Extraversion": int(center.get("Extraversion", 50)),
-        "Agreeableness": int(center.get("Agreeableness", 50)),
-        "Conscientiousness": int(center.get("Conscientiousness", 50)),
-        "Emotional Stability": int(center.get("Emotional Stability", 50)),
-        "Openness": int(center.get("Openness", 50)),
-        # 以降は Chat 時に参照されないが、関数互換のためキー揃え
-        "Username": "",
-        "ExperimentCondition": "Personalized Empathy",
-    }
-
-def make_user_inputs_from_group(gdf, min_count=60, seed=0):
-    """
-    類似スコア群 (gdf) からユーザー入力（text）を少なくとも min_count 個用意。
-    足りない場合はリサンプリングで補う。
-    """
-    rs = gdf.sample(frac=1, random_state=seed)['text'].tolist()
-    if len(rs) >= min_count:
-        return rs[:min_count]
-    # 足りなければループして補完
-    out = []
-    i = 0
-    while len(out) < min_count:
-        out.append(rs[i % len(rs)])
-        i += 1
-    return out
-
-def run_simulation_for_user_slow(username, profile_dict, user_inputs, session_id, flip_after=30, delay_sec=0):
-    chat_history = []
-    progress = st.empty()
-
-    for turn_index, ux in enumerate(user_inputs, start=1):
-        match = (turn_index >= flip_after)
-        exp_cond = st.session_state.get("experiment_condition", "Personalized Empathy")
-
-        # ログ用フラグと Phase（Fixedは常にNoMatch扱い／Phaseは空）
-        matched_for_log = (match if exp_cond != "Fixed Empathy" else False)
-        phase = (("Matched" if match else "NoMatch") if exp_cond != "Fixed Empathy" else "")
-
-        # トーン分岐
-        if exp_cond == "Fixed Empathy":
-            tone_instruction = "Respond in a calm, supportive tone, like a counselor."
-            used = {
-                "E": profile_dict.get("Extraversion", 50),
-                "A": profile_dict.get("Agreeableness", 50),
-                "C": profile_dict.get("Conscientiousness", 50),
-                "ES": profile_dict.get("Emotional Stability", 50),
-                "O": profile_dict.get("Openness", 50),
-            }      
-        else:
-            tone_data = determine_tone(profile_dict, match=match)
-            tone_instruction = (
-                f"Respond in a {tone_data['tone']}, {tone_data['empathy']} way. "
-                f"Keep tone {tone_data['emotional']} and include {tone_data['creativity']} ideas. "
-                f"{tone_data['special_instruction']}"
-            )
-            used = tone_data["used_traits"]
-        profile_summary = ", ".join([
-            f"Extraversion={profile_dict.get('Extraversion','N/A')}",
-            f"Agreeableness={profile_dict.get('Agreeableness','N/A')}",
-            f"Conscientiousness={profile_dict.get('Conscientiousness','N/A')}",
-            f"Emotional Stability={profile_dict.get('Emotional Stability','N/A')}",
-            f"Openness={profile_dict.get('Openness','N/A')}",
-        ])
-        context = "\n".join([f"{m['role']}: {m['content']}" for m in chat_history[-4:]])
-        prompt = f"""
-You are a warm, supportive mental health assistant.
-Reflect this personality style: {tone_instruction}.
-Write a natural, conversational response in 2–3 sentences:
-- Acknowledge the user's concern using their own words.
-- Ask ONE relevant question to keep the conversation going.
-Avoid sounding like a list. Make it flow like a real chat.
--Suggest ONE practical coping tip based on their personality ({profile_summary}) and briefly explain why it helps.
-Avoid phrases like "I understand" or "That sounds tough".
-Keep it empathetic, practical, and conversational.
-Conversation so far:
-{context}
-User: {ux}
-Assistant:
-""".strip()
-
-        crisis_msg = handle_crisis(ux)
-        ai_reply = crisis_msg if crisis_msg else (call_api(prompt) or "[Simulation] No response.")
-
-        chat_history.extend([{"role":"User","content":ux},{"role":"AI","content":ai_reply}])
-
-        # --- ログ書き込み（正しい順序/引数で1回だけ） ---
-        ws = get_user_log_ws_cached(username, matched_for_log)
-        ts_iso = datetime.utcnow().isoformat()
-
-        # "Group {k} Simulated User {n}" から抽出
-        try:
-            parts = username.split()
-            group_id = int(parts[1]); user_index = int(parts[-1])
-        except Exception:
-            group_id = 0; user_index = 0
-
-        log_chat_to_sheet(
-            ws,                 # 1) ws
-            session_id,         # 2) SessionID（呼び出し元で生成）
-            username,           # 3) Username
-            ux,                 # 4) User message
-            ai_reply,           # 5) AI message
-            ts_iso,             # 6) Timestamp
-            exp_cond,           # 7) ExperimentCondition
-            matched_for_log,    # 8) MatchedMode(bool)
-            turn_index,         # 9) Turn (1..60)
-            phase,              # 10) Phase
-            group_id,           # 11) GroupID
-            user_index,          # 12) UserIndex
-            used.get("E",""), used.get("A",""), used.get("C",""), used.get("ES",""), used.get("O","")
-        )
-
-        progress.text(f"{username}: {turn_index}/{len(user_inputs)} processed...")
-    
-
-# === 危機対応 ===
-def handle_crisis(user_input):
-    keywords = ["suicide", "kill myself", "end my life", "self-harm"]
-    if any(kw in user_input.lower() for kw in keywords):
-        return "I'm really sorry you're feeling this way. You're not alone. Please contact someone you trust or a hotline."
-    return None
-
-def build_prompt(user_input, context, tone_instruction, profile_summary):
-    return f"""
-You are a mental well-being assistant.
-Reflect these traits strongly: {tone_instruction}.
-Respond in 2–3 sentences:
-1. Acknowledge the user's concern using their words.
-2. Ask a relevant question.
-3. Suggest ONE action tailored to their personality ({profile_summary}) and explain why it helps.
-Avoid phrases like "I understand". Use a warm, natural tone.
-Conversation so far:
-{context}
-User's message: {user_input}
-Assistant:
-""".strip()
-
-
-def call_api(prompt):
-    API_URL = "https://royalmilktea103986368-dissintation.hf.space/generate"
-    payload = {"prompt": prompt, "max_tokens": 180, "temperature": 0.7, "top_p": 0.95}
-    for attempt in range(4):
-        try:
-            r = requests.post(API_URL, json=payload, timeout=20)
-            if r.status_code == 200:
-                text = r.json().get("response", "").strip()
-                if text:
-                    return text.split("Assistant:")[-1].replace("\n\n", "\n").strip()
-        except:
-            time.sleep(2 ** attempt)
-    return None
-
 # === ユーザーとページ管理 ===
 user_name = st.sidebar.text_input("Enter your username")
 if not user_name:
@@ -537,13 +70,11 @@ st.session_state.user_name = user_name
 
 
 # すでに登録されているユーザーか確認
-_all_profiles = get_all_profiles_cached()
-existing_users = [row.get("Username") for row in _all_profiles]
-if st.session_state.user_name in existing_users:
-    user_row = next(row for row in _all_profiles if row.get("Username") == st.session_state.user_name)
+user_row = get_profile(st.session_state.user_name)
+if user_row is not None:
     st.session_state.experiment_condition = user_row.get("ExperimentCondition", "Fixed Empathy")
 else:
-    st.session_state.experiment_condition = "Fixed Empathy" if len(existing_users) % 2 == 0 else "Personalized Empathy"
+    st.session_state.experiment_condition = "Fixed Empathy" if get_profile_store().count() % 2 == 0 else "Personalized Empathy"
 
 
 # ✅ ページ自動選択
@@ -685,7 +216,7 @@ if page == "Personality Test":
                 scores["Emotional Stability"], scores["Openness"],
                 responses_json
             ]
-            safe_append(profile_sheet, row)
+            get_profile_store().append(row)
 
             # 結果表示
             st.success("Profile saved!")
@@ -722,63 +253,47 @@ if page == "Chat Session":
         st.error("No personality profile found. Please take the personality test first.")
         st.stop()
 
+    # これまでの会話を先に描画（新しいターンは下にそのまま流し込む）
+    for msg in st.session_state.chat_history:
+        st.chat_message(msg["role"].lower()).write(msg["content"])
+
     user_input = st.chat_input("Your message...")
     if user_input:
         st.session_state.turn_index += 1
         is_fixed = (st.session_state.get("experiment_condition") == "Fixed Empathy")
         st.session_state['matched_mode'] = (False if is_fixed else (st.session_state.turn_index >= 30))
 
-        context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in st.session_state.chat_history[-4:]])
+        prompt, used = build_chat_prompt(
+            profile,
+            st.session_state.get("experiment_condition"),
+            st.session_state.turn_index,
+            st.session_state.chat_history,
+            user_input,
+        )
 
-
-        # モード設定
-        if st.session_state.get("experiment_condition") == "Fixed Empathy":
-            tone_instruction = "Respond in a calm, supportive tone, like a counselor."
-            used = {
-                "E": profile.get("Extraversion", ""),
-                "A": profile.get("Agreeableness", ""),
-                "C": profile.get("Conscientiousness", ""),
-                "ES": profile.get("Emotional Stability", ""),
-                "O": profile.get("Openness", "")
-            }            
-        else:
-            tone_data = determine_tone(profile, match=(st.session_state.turn_index >= 30))
-            tone_instruction = (
-                f"Respond in a {tone_data['tone']}, {tone_data['empathy']} way. "
-                f"Keep tone {tone_data['emotional']} and include {tone_data['creativity']} ideas. "
-                f"{tone_data['special_instruction']}"
-            )
-            used = tone_data["used_traits"]
+        st.chat_message("user").write(user_input)
 
         crisis_msg = handle_crisis(user_input)
         if crisis_msg:
             ai_reply = crisis_msg
+            st.chat_message("ai").write(ai_reply)
         else:
-            profile_summary = ", ".join([
-                f"Extraversion={profile.get('Extraversion', 'N/A')}",
-                f"Agreeableness={profile.get('Agreeableness', 'N/A')}",
-                f"Conscientiousness={profile.get('Conscientiousness', 'N/A')}",
-                f"Emotional Stability={profile.get('Emotional Stability', 'N/A')}",
-                f"Openness={profile.get('Openness', 'N/A')}"
-            ])
-
-            prompt = f"""
-            You are a warm, supportive mental health assistant.
-            Reflect this personality style: {tone_instruction}.
-            Write a natural, conversational response in 2–3 sentences:
-            - Acknowledge the user's concern using their own words.
-            - Ask ONE relevant question to keep the conversation going.
-            Avoid sounding like a list. Make it flow like a real chat.
-            -Suggest ONE practical coping tip based on their personality ({profile_summary}) and briefly explain why it helps.
-            Avoid phrases like "I understand" or "That sounds tough".
-            Keep it empathetic, practical, and conversational.
-            Conversation so far:
-            {context}
-            User: {user_input}
-            Assistant:
-            """.strip()
-
-            ai_reply = call_api(prompt) or "The system could not generate a response. Try again. If that doesn't work contact Ryosuke Komatsu"
+            with st.chat_message("ai"):
+                if CHAT_STREAMING:
+                    # トークンが届いた順に表示（体感の待ち時間＝最初のトークンまで）。繰り返されたプロンプトは出さない
+                    bubble = st.empty()
+                    streamed = bubble.write_stream(strip_prompt_echo(
+                        get_generation_client().stream(prompt, conversation_id=st.session_state.session_id), prompt))
+                    ai_reply = clean_reply(streamed) if isinstance(streamed, str) and streamed.strip() else None
+                    if ai_reply:
+                        bubble.write(ai_reply)   # 表示もログに残す文面（clean_reply 後）に揃える
+                else:
+                    ai_reply = call_api(prompt, conversation_id=st.session_state.session_id)
+                    if ai_reply:
+                        st.write(ai_reply)
+                if not ai_reply:
+                    ai_reply = "The system could not generate a response. Try again. If that doesn't work contact Ryosuke Komatsu"
+                    st.write(ai_reply)
 
         st.session_state.chat_history.append({"role": "User", "content": user_input})
         st.session_state.chat_history.append({"role": "AI", "content": ai_reply})
@@ -829,172 +344,95 @@ if page == "Chat Session":
                 st.markdown(f"[Click here for the {milestone}th message survey]({survey_links[key]})")
 
 
-    for msg in st.session_state.chat_history:
-        st.chat_message(msg["role"].lower()).write(msg["content"])
-
-#「続きからシミュレーション再開」できるように進捗を永続化
-def get_meta_ws():
-    try:
-        return spreadsheet.worksheet("SIM_META")
-    except gspread.exceptions.WorksheetNotFound:
-        ws = spreadsheet.add_worksheet(title="SIM_META", rows="100", cols="3")
-        ws.append_row(["Key","Value","UpdatedAt"])
-        return ws
-
-def read_sim_state(key="DISJOINT_PTR"):
-    ws = get_meta_ws()
-    try:
-        cells = ws.findall(key)
-        if not cells:
-            return None
-        row = ws.row_values(cells[-1].row)
-        return int(row[1])
-    except Exception:
-        return None
-
-def write_sim_state(key, value):
-    ws = get_meta_ws()
-    ts = datetime.utcnow().isoformat() 
-    safe_append_ws(ws, [key, str(value), ts])
-
-
-# ==== Checkpoint helpers (resume on rerun) ====
-CKP_USER_KEY   = "CKP_USER"      # "Group X Simulated User Y"
-CKP_TURN_KEY   = "CKP_TURN"      # 最後に完了したターン番号（int）
-CKP_MODE_KEY   = "CKP_MODE"      # 'Fixed' / 'Pers_NoMatch' / 'Pers_Matched'
-CKP_SESSION_KEY= "CKP_SESSION"   # セッションID
-
-def read_checkpoint():
-    user = read_sim_state(CKP_USER_KEY)
-    turn = read_sim_state(CKP_TURN_KEY)
-    mode = read_sim_state(CKP_MODE_KEY)
-    sid  = read_sim_state(CKP_SESSION_KEY)
-    if user is None or turn is None:
-        return None
-    return {
-        "username": user if isinstance(user, str) else str(user),
-        "last_turn": int(turn),
-        "mode": (mode if isinstance(mode, str) else str(mode)) if mode is not None else "",
-        "session_id": (sid if isinstance(sid, str) else str(sid)) if sid is not None else ""
-    }
-
-def write_checkpoint(username, last_turn, mode, session_id):
-    write_sim_state(CKP_USER_KEY, username)
-    write_sim_state(CKP_TURN_KEY, int(last_turn))
-    write_sim_state(CKP_MODE_KEY, mode)
-    write_sim_state(CKP_SESSION_KEY, session_id)
-
-def clear_checkpoint():
-    write_sim_state(CKP_USER_KEY, "")
-    write_sim_state(CKP_TURN_KEY, -1)
-    write_sim_state(CKP_MODE_KEY, "")
-    write_sim_state(CKP_SESSION_KEY, "")
-
-
-
-
-def next_slow_seq():
-    val = read_sim_state("SLOW_SEQ")
-    val = 0 if val is None else int(val)
-    write_sim_state("SLOW_SEQ", val + 1)
-    return val + 1
-
-
 # === Admin Debug Panel ===
 if user_name.lower() == "admin":
     st.sidebar.markdown("### Debug Panel")
     st.sidebar.write(f"Your Condition: {st.session_state['experiment_condition']}")
     st.sidebar.write(f"Match Mode: {st.session_state.get('matched_mode', False)}")
+    log_stats = get_log_pipeline().stats()
+    st.sidebar.write(
+        f"Log WAL: {log_stats['pending_rows']} rows waiting for Sheets (oldest {log_stats['oldest_pending_sec']}s) | "
+        f"Replicated: {log_stats['replicated_rows']} rows | Failed sends: {log_stats['failed_batches']} (will retry)"
+    )
+    quota = sheets_quota_stats()
+    if quota is not None:
+        st.sidebar.write(
+            f"Sheets (memory backend) last 60s: {quota['reads_last_min']}/{quota['read_limit']} reads, "
+            f"{quota['writes_last_min']}/{quota['write_limit']} writes | "
+            f"peak {quota['peak_reads_per_min']}/{quota['peak_writes_per_min']} | 429s {quota['throttled'] + quota['injected']}"
+        )
 
     st.sidebar.markdown("---")
     st.sidebar.subheader("Slow Simulation (rate-limited)")
     sim_users_slow = st.sidebar.number_input("Users (slow)", min_value=1, max_value=50, value=1, step=1)
     sim_step_slow  = st.sidebar.slider("Trait window (±, slow)", min_value=5, max_value=20, value=10, step=1)
     sim_turns_slow = 60
-    sim_delay      = st.sidebar.slider("Delay between turns (sec)", min_value=0.5, max_value=10.0, value=2.0, step=0.5)
+    sim_delay      = st.sidebar.slider("Delay between turns (sec)", min_value=0.0, max_value=10.0, value=2.0, step=0.5)
+    sim_workers    = st.sidebar.number_input("Concurrent users", min_value=1, max_value=32, value=4, step=1)
+    sim_rps        = st.sidebar.slider("API requests / sec (all users)", min_value=0.1, max_value=10.0, value=1.0, step=0.1)
+    sim_batch_size = st.sidebar.number_input("Batch prompts across users (1 = off)", min_value=1, max_value=32, value=1, step=1,
+                                             help="Sends the current turn of up to N concurrent users to /generate_batch in one request.")
+    sim_batch_wait_ms = st.sidebar.slider("Batch max wait (ms)", min_value=0, max_value=1000, value=50, step=10)
+    use_response_cache = st.sidebar.checkbox("Replay cached API responses (disk cache)", value=False)
+    if use_response_cache:
+        cache_stats = get_response_cache().stats()
+        st.sidebar.write(
+            f"Response cache: {cache_stats['entries']} entries ({cache_stats['bytes'] // 1024} KB) | "
+            f"hits {cache_stats['hits']} / misses {cache_stats['misses']}"
+        )
+        if st.sidebar.button("Pre-warm cache from LOGS_* sheets"):
+            log_rows = []
+            for title in ("LOGS_FIXED", "LOGS_PERS_NOMATCH", "LOGS_PERS_MATCHED"):
+                try:
+                    log_rows.extend(get_worksheet(title).get_all_records())
+                except gspread.exceptions.WorksheetNotFound:
+                    pass
+            added = prewarm_response_cache(get_response_cache(), log_rows)
+            st.sidebar.success(f"Cached {added} responses from logs.")
     use_disjoint_batches = st.sidebar.checkbox("Use disjoint 60-text batches (no overlap)", value=True)
 
-    if st.sidebar.button("Run Big5Chat Simulation (Slow)"):
+    if use_disjoint_batches:
+        # disjoint バッチは sim_runner.py（ブラウザ不要・ワーカープロセス）で回す。ここでは進捗だけを表示する
+        df = load_big5chat()
+        plan = get_disjoint_plan(df, big5_dataset_key(), batch_size=int(sim_turns_slow), seed=42)
+        status = read_runner_status(refresh=st.sidebar.button("Refresh progress"))
+        ptr = read_sim_state("DISJOINT_PTR") or 0
+        st.sidebar.write(f"Progress: {ptr} / {len(plan)} | API calls left: {plan.api_budget(ptr, len(plan))}")
+        # 進捗ポインタは作成時のプランの並びを指している。プランが変わると（データ差し替え・割り当て方の変更）
+        # 続きのユーザーが既に使った発話を受け取ることがある（sim_runner.py は --force なしでは起動しない）
+        conflict = disjoint_plan_conflict(plan, ptr, get_sim_state_store().get("DISJOINT_PLAN"))
+        if conflict:
+            st.sidebar.warning(conflict + " sim_runner.py refuses to continue without --force.")
+        if status is None:
+            st.sidebar.info("No headless runner has reported yet.")
+        else:
+            state = status.get("state", "?")
+            if state == "running" and not status["alive"]:
+                state = "stale (no heartbeat; the runner probably died)"
+            st.sidebar.write(
+                f"Runner: {state} on {status.get('host')} (pid {status.get('pid')}) | "
+                f"batches {status.get('start_ptr')}..{status.get('end_ptr', 0) - 1} | done {status.get('done', 0)} | "
+                f"failed {status.get('failed', 0)} | skipped (name taken) {len(status.get('conflicts', []))} | "
+                f"updated {status['age_sec']}s ago"
+            )
+            if status.get("running"):
+                st.sidebar.write("In progress: " + ", ".join(status["running"]))
+        st.sidebar.caption("Start or resume the disjoint run from a shell (it keeps going without this tab):")
+        st.sidebar.code(
+            f"python sim_runner.py --users {int(sim_users_slow)} --processes 2 --threads {int(sim_workers)} "
+            f"--rps {sim_rps} --delay {sim_delay} --batch-size {int(sim_batch_size)}"
+            + (" --response-cache" if use_response_cache else "")
+        )
+
+    elif st.sidebar.button("Run Big5Chat Simulation (Slow)"):
         with st.spinner("Simulating slowly to respect API quotas..."):
             df = load_big5chat()
             rng = random.Random(42)
 
-            if use_disjoint_batches:
-
-                if "DISJOINT_BATCHES" not in st.session_state:
-                    st.session_state.DISJOINT_BATCHES = build_disjoint_batches(
-                        df, batch_size=int(sim_turns_slow), seed=42
-                    )
-                # 1) 60件バッチを一度だけ構築 & 進捗ポインタの読み戻し
-                batches = st.session_state.DISJOINT_BATCHES
-                total_batches = len(st.session_state.DISJOINT_BATCHES)
-                ptr_saved = read_sim_state("DISJOINT_PTR")
-                ptr = ptr_saved if ptr_saved is not None else st.session_state.get("DISJOINT_PTR", 0)
-
-                st.sidebar.write(f"Progress: {ptr} / {total_batches}")
-                run_all = st.sidebar.checkbox("Run ALL remaining (disjoint)", value=False)
-
-                batches = st.session_state.DISJOINT_BATCHES
-                remaining = total_batches - ptr    
-                take = remaining if run_all else int(sim_users_slow) 
-                end_ptr = min(ptr + take, len(batches))
-
-                # 2) 交互割当 → 登録 → 実行（毎ユーザー固有の SessionID）
-                for bidx in range(ptr, end_ptr):
-                    b = batches[bidx]
-
-                    # 交互割当（既存人数の偶奇）
-                    _all = get_all_profiles_cached()
-                    experiment_condition = "Fixed Empathy" if (len(_all) % 2 == 0) else "Personalized Empathy"
-                    st.session_state.experiment_condition = experiment_condition
-
-                    username = f"Group {b['group_id']} Simulated User {b['user_index']}"
-                    session_id = str(uuid.uuid4())  # ← 毎ユーザー固有
-
-                    profile_dict = build_profile_from_center(b["center"])
-                    ensure_personality_row(
-                        username=username,
-                        session_id=session_id,
-                        experiment_condition=experiment_condition,
-                        profile_dict=profile_dict,
-                        responses_json=json.dumps({"source":"simulation_disjoint","group":b["group_id"],"user_index":b["user_index"]})
-                    )
-
-                    st.info(f"Slow run for {username} | center={b['center']} | turns={len(b['texts'])} | condition={experiment_condition}")
-
-                    # （任意：事前にログWSを作成すると切替時も安定）
-                    if experiment_condition == "Personalized Empathy":
-                        _ = get_user_log_ws_cached(username, matched=False)  # NoMatch
-                        _ = get_user_log_ws_cached(username, matched=True)   # Matched
-                    else:
-                        _ = get_user_log_ws_cached(username, matched=False)  # Fixedは1枚のみ
-
-                    try:
-                        run_simulation_for_user_slow(
-                                username=username,
-                                profile_dict=profile_dict,
-                                user_inputs=b["texts"],
-                                session_id=session_id,
-                                flip_after=30,
-                                delay_sec=float(sim_delay)
-                        )
-                    except Exception as e:
-                        st.error(f"Simulation failed for {username}: {e}")
-                        write_sim_state("FAILED_USER", username)
-                        continue
-
-                    next_ptr = bidx + 1
-                    st.session_state.DISJOINT_PTR = next_ptr
-                    write_sim_state("DISJOINT_PTR", next_ptr)
-
-
-            else:
-                # 旧来の「±windowから60件サンプル」モード（ユーザー名を disjoint と同形式で統一）
+            # 旧来の「±windowから60件サンプル」モード（ユーザー名を disjoint と同形式で統一）
+            def window_jobs():
                 for i in range(int(sim_users_slow)):
-                    _all_profiles = get_all_profiles_cached()
-                    existing_users = [row.get("Username") for row in _all_profiles]
-                    experiment_condition = "Fixed Empathy" if (len(existing_users) % 2 == 0) else "Personalized Empathy"
-                    st.session_state.experiment_condition = experiment_condition
+                    experiment_condition = "Fixed Empathy" if (get_profile_store().count() % 2 == 0) else "Personalized Empathy"
 
                     # ← NEW: 連番から group_id / user_index を決める
                     # ===== 置換ここから =====
@@ -1016,12 +454,12 @@ if user_name.lower() == "admin":
                         "Emotional Stability": to_bins(row['Emotional Stability'], step=sim_step_slow),
                         "Openness": to_bins(row['Openness'], step=sim_step_slow),
                     }
-                    gdf = group_by_trait_window(df, center, window=sim_step_slow)
-                    if gdf.empty:
+                    row_ids = get_trait_index(df, big5_dataset_key()).query(center, window=sim_step_slow)
+                    if len(row_ids) == 0:
                         st.warning(f"[Slow {username}] No samples in ±{sim_step_slow} for center={center}. Skipped.")
                         continue
 
-                    inputs = make_user_inputs_from_group(gdf, min_count=int(sim_turns_slow), seed=100+i)
+                    inputs = make_user_inputs_from_group(df, row_ids, min_count=int(sim_turns_slow), seed=100+i)
                     profile_dict = build_profile_from_center(center)
 
                     ensure_personality_row(
@@ -1035,19 +473,36 @@ if user_name.lower() == "admin":
                     st.info(f"Slow run for {username}, center={center}, inputs={len(inputs)}, condition={experiment_condition}")
 
                     if experiment_condition == "Personalized Empathy":
-                        _ = get_user_log_ws_cached(username, matched=False)
-                        _ = get_user_log_ws_cached(username, matched=True)
+                        _ = get_user_log_ws_cached(username, matched=False, experiment_condition=experiment_condition)
+                        _ = get_user_log_ws_cached(username, matched=True, experiment_condition=experiment_condition)
                     else:
-                        _ = get_user_log_ws_cached(username, matched=False)
+                        _ = get_user_log_ws_cached(username, matched=False, experiment_condition=experiment_condition)
+
+                    yield {
+                        "username": username,
+                        "profile_dict": profile_dict,
+                        "user_inputs": inputs,
+                        "session_id": session_id,
+                        "flip_after": 30,
+                        "experiment_condition": experiment_condition,
+                    }
 
-                    run_simulation_for_user_slow(
-                        username=username,
-                        profile_dict=profile_dict,
-                        user_inputs=inputs,
-                        session_id=session_id,
-                        flip_after=30,
-                        delay_sec=float(sim_delay)
-                    )
+            def on_window_done(i, job, error):
+                if error is not None:
+                    st.error(f"Simulation failed for {job['username']}: {error}")
+                    write_sim_state("FAILED_USER", job["username"])
+
+            run_simulations_concurrently(
+                window_jobs(),
+                max_workers=int(sim_workers),
+                requests_per_sec=float(sim_rps),
+                delay_sec=float(sim_delay),
+                on_done=on_window_done,
+                cache=get_response_cache() if use_response_cache else None,
+                batch_size=int(sim_batch_size),
+                batch_wait_sec=sim_batch_wait_ms / 1000.0,
+            )
 
 
+        get_log_pipeline().flush()
         st.success("Slow simulation finished.")